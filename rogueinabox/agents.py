@@ -24,7 +24,10 @@ import os
 from abc import ABC, abstractmethod
 
 from logger import Logger, Log
+from profiler import format_profile
 from rogueinabox import RogueBox
+from vecroguebox import VecRogueBox, SubprocVecRogueBox
+from config import ConfigurationError
 from stalkomatic import StalkOMatic
 from ui.UIManager import UIManager
 
@@ -152,12 +155,13 @@ class StalkerAgent(Agent):
         # class instances
         self.rogomatic = StalkOMatic(configs)
         self.model_manager = getattr(models, configs["model_manager"])(self.rogomatic)
-        self.history_manager = getattr(history, configs["history_manager"])(self)
         # configs
         self.configs = configs
         self.configs["iteration"] = 1
         self.configs["actions"] = self.rogomatic.get_actions()
         self.configs["actions_num"] = len(self.configs["actions"])
+        # the history manager reads the configs
+        self.history_manager = getattr(history, configs["history_manager"])(self)
         # gui stuff
         ui = None
         log_targets = []
@@ -259,11 +263,13 @@ class StalkerAgent(Agent):
                 self.l.log(dead_log)
                 self.starting = True
                 self.rogomatic.reset()
+                self.history_manager.end_game()
             elif self.is_freezed():
                 freeze_log = [Log("freeze_log", "Rogomatic froze. Let's kill it with fire!", 2)]
                 self.l.log(freeze_log)
                 self.starting = True
                 self.rogomatic.reset()
+                self.history_manager.end_game()
 
 # LEARNER AGENTS
 
@@ -272,14 +278,19 @@ class QLearnerAgent(LearnerAgent):
         import models, history
         
         # class instances
-        self.rb = RogueBox(configs)
+        self.rb = self._init_roguebox(configs)
         self.model_manager = getattr(models, configs["model_manager"])(self.rb)
-        self.history_manager = getattr(history, configs["history_manager"])(self)
         # configs
         self.configs = configs
         self.configs["iteration"] = 1
         self.configs["actions"] = self.rb.get_actions()
         self.configs["actions_num"] = len(self.configs["actions"])
+        # the history manager reads the configs
+        self.history_manager = getattr(history, configs["history_manager"])(self)
+        self.prefetcher = None
+        if configs["prefetch_batches"] > 0:
+            self.prefetcher = history.MinibatchPrefetcher(self.history_manager, configs["batchsize"],
+                                                          configs["prefetch_batches"])
         # gui stuff
         ui = None
         log_targets = []
@@ -295,8 +306,7 @@ class QLearnerAgent(LearnerAgent):
             log_targets.append("terminal")
             self.l = Logger(log_depth=configs["verbose"], log_targets=log_targets)
         # state
-        self.state = self.model_manager.reshape_initial_state(self.rb.compute_state())
-        self.old_state = self.state
+        self._reinit()
         # model
         self.model = self.model_manager.build_model()
         self.target_model = self.model_manager.build_model()
@@ -305,6 +315,9 @@ class QLearnerAgent(LearnerAgent):
         # load weights, transitions history and parameters from assets, if any
         self._load_progress()
 
+    def _init_roguebox(self, configs):
+        return RogueBox(configs)
+
     def _load_progress(self):
         # model weights
         if os.path.isfile("assets/weights.h5"):
@@ -352,6 +365,8 @@ class QLearnerAgent(LearnerAgent):
     def _reinit(self):
         self.state = self.model_manager.reshape_initial_state(self.rb.compute_state())
         self.old_state = self.state
+        # the game was restarted
+        self.history_manager.end_game()
 
     def predict(self):
         """return a numpy array of length actions_num all set to 0
@@ -386,28 +401,25 @@ class QLearnerAgent(LearnerAgent):
     def observe(self):
         timer_log = [Log("Observe_time", "Ten observe done", LOG_LEVEL_MORE, mean=10)]
         self.l.start_log_timer(timer_log)
-        minibatch = self.history_manager.pick_batch(self.configs["batchsize"])
-        inputs = np.zeros((self.configs["batchsize"],) + self.state.shape[1:])
-        targets = np.zeros((self.configs["batchsize"], self.configs["actions_num"]))
-
-        # Now we do the experience replay
-        for i in range(self.configs["batchsize"]):
-            old_state = minibatch[i][0]
-            action_index = minibatch[i][1]
-            reward = minibatch[i][2]
-            new_state = minibatch[i][3]
-            terminal = minibatch[i][4]
-
-            inputs[i] = old_state
-            targets[i] = self.model.predict(old_state)
-
-            if terminal:
-                targets[i, action_index] = reward
-            else:
-                Q_new_state = self.target_model.predict(new_state)
-                targets[i, action_index] = reward + self.configs["gamma"] * np.max(Q_new_state)
-
-        loss = self.model.train_on_batch(inputs, targets)
+        if self.prefetcher is not None:
+            minibatch = self.prefetcher.get()
+        else:
+            minibatch = self.history_manager.pick_batch(self.configs["batchsize"])
+        # the stored states keep the leading batch dimension of the agent state
+        inputs = minibatch.states.reshape((-1,) + self.state.shape[1:])
+        new_states = minibatch.next_states.reshape((-1,) + self.state.shape[1:])
+
+        # Now we do the experience replay, on the whole minibatch at once
+        targets = self.model.predict(inputs)
+        Q_new_states = self.target_model.predict(new_states)
+        updates = np.where(minibatch.terminals, minibatch.rewards,
+                           minibatch.rewards + minibatch.discounts * np.max(Q_new_states, axis=1))
+        rows = np.arange(len(targets))
+        self.history_manager.update_priorities(minibatch.indices, updates - targets[rows, minibatch.actions],
+                                               minibatch.versions)
+        targets[rows, minibatch.actions] = updates
+
+        loss = self.model.train_on_batch(inputs, targets, sample_weight=minibatch.weights)
         loss_log = [Log("loss_value", "Loss for this iteration: {}".format(loss), LOG_LEVEL_SOME)]
         self.l.log(loss_log)
         self.l.stop_log_timer(timer_log)
@@ -456,9 +468,17 @@ class QLearnerAgent(LearnerAgent):
             self.ui.on_key_press(self._train_key_callback)
             self.ui.start_ui()
         else:
-            while True:
-                self._train_step(self.configs["iteration"])
-                self.configs["iteration"] += 1
+            try:
+                while True:
+                    self._train_step(self.configs["iteration"])
+                    self.configs["iteration"] += 1
+            finally:
+                self.stop()
+
+    def stop(self):
+        """stop the threads the agent started"""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
 
     def _train_step(self, iteration):
         action_index = self.predict()
@@ -470,6 +490,7 @@ class QLearnerAgent(LearnerAgent):
             log_iteration = [Log("iteration", "Iteration number: {}".format(self.configs["iteration"]), LOG_LEVEL_SOME)]
             log_iteration += [Log("hist", "History size: {}".format(self.history_manager.hist_len()), LOG_LEVEL_SOME)]
             self.l.log(log_iteration)
+        self._log_step_profile(self.rb, iteration)
         # Begin training only when we have enough history
         if self.history_manager.hist_len() >= self.configs["minhist"] and item_added:
             self.observe()
@@ -491,6 +512,13 @@ class QLearnerAgent(LearnerAgent):
             self.rb.reset()
             self._reinit()
 
+    def _log_step_profile(self, rb, iteration):
+        """log where the steps of the last profile_every iterations spent their time"""
+        if self.configs["profile_steps"] and self.configs["profile_every"] > 0 and \
+                iteration % self.configs["profile_every"] == 0:
+            profile_log = [Log("step_profile", format_profile(rb.get_step_profile(reset=True)), LOG_LEVEL_SOME)]
+            self.l.log(profile_log)
+
     def run(self):
         # dont act randomly
         self.configs["epsilon"] = 0
@@ -510,6 +538,7 @@ class QLearnerAgent(LearnerAgent):
     def _train_key_callback(self, event):
         """Callback for keys pressed during learning"""
         if event.char == 'q' or event.char == 'Q':
+            self.stop()
             self.rb.quit_the_game()
             exit()
 
@@ -553,6 +582,121 @@ class QLearnerAgent(LearnerAgent):
         pass
 
 
+class VecQLearnerAgent(QLearnerAgent):
+    """A QLearnerAgent playing configs["num_envs"] games at once through a VecRogueBox.
+    The actions for all the games are chosen with a single batched prediction per tick.
+    self.rb is the first game, it is used for the gui and by the model manager.
+    If configs["num_workers"] is more than 1 the games run in a SubprocVecRogueBox,
+    in this case there is no local game and the gui is not available"""
+
+    def __init__(self, configs):
+        if configs["num_workers"] > 1 and configs["gui"]:
+            raise ConfigurationError("The gui is not available with more than one worker.")
+        super().__init__(configs)
+        self.env_index = 0
+
+    def _init_roguebox(self, configs):
+        if configs["num_workers"] > 1:
+            self.vrb = SubprocVecRogueBox(configs)
+            return self.vrb
+        self.vrb = VecRogueBox(configs)
+        return self.vrb.boxes[0]
+
+    def _reinit(self):
+        self.states = self._reshape_initial_states(self.vrb.compute_states())
+        self.old_states = self.states
+        self.state = self.states[0:1]
+        self.old_state = self.state
+        # all the games were restarted
+        self.history_manager.end_game()
+
+    def _reshape_initial_states(self, frames):
+        return np.concatenate([self.model_manager.reshape_initial_state(frame) for frame in frames])
+
+    def _reshape_new_states(self, old_states, frames):
+        return np.concatenate([self.model_manager.reshape_new_state(old_states[i:i+1], frame)
+                               for i, frame in enumerate(frames)])
+
+    def predict(self):
+        """return the index of the action to take in each game, chosen epsilon greedy"""
+        num_envs = self.vrb.num_envs
+        q = self.model.predict(self.states)
+        actions = self.configs["actions"]
+        if self.configs["only_legal_actions"]:
+            for i, legal_actions in enumerate(self.vrb.get_legal_actions()):
+                for action in actions:
+                    if action not in legal_actions:
+                        q[(i, actions.index(action))] = -np.inf
+        action_indexes = np.argmax(q, axis=1)
+        explore = np.random.random(num_envs) <= self.configs["epsilon"]
+        action_indexes[explore] = np.random.randint(self.configs["actions_num"], size=np.count_nonzero(explore))
+        logs = [Log("actions_array", "This is the action array: {}".format(q), LOG_LEVEL_MORE)]
+        self.l.log(logs)
+        return action_indexes
+
+    def act(self, action_indexes):
+        commands = [self.configs["actions"][action_index] for action_index in action_indexes]
+        rewards, new_states, terminals = self.vrb.step(commands)
+        logs = [Log("action_reward", "Sent actions: {} got rewards: {}".format(commands, rewards), LOG_LEVEL_MORE)]
+        self.l.log(logs)
+        self.old_states = self.states
+        # the transitions of ended games lead to their final state, not to the restarted game
+        next_frames = list(new_states)
+        for i, final_state in self.vrb.final_states.items():
+            next_frames[i] = final_state
+        self.next_states = self._reshape_new_states(self.old_states, next_frames)
+        self.states = self.next_states.copy()
+        for i in self.vrb.final_states:
+            self.states[i:i+1] = self.model_manager.reshape_initial_state(new_states[i])
+        return rewards, terminals
+
+    def _train_step(self, iteration):
+        action_indexes = self.predict()
+        rewards, terminals = self.act(action_indexes)
+        item_added = False
+        for i in range(self.vrb.num_envs):
+            # the history managers read the transition from old_state and state
+            self.env_index = i
+            self.old_state = self.old_states[i:i+1]
+            self.state = self.next_states[i:i+1]
+            item_added |= self.history_manager.update_history(action_indexes[i], rewards[i], terminals[i])
+        self.state = self.states[0:1]
+        if iteration % 10 == 0:
+            log_iteration = [Log("iteration", "Iteration number: {}".format(self.configs["iteration"]), LOG_LEVEL_SOME)]
+            log_iteration += [Log("hist", "History size: {}".format(self.history_manager.hist_len()), LOG_LEVEL_SOME)]
+            self.l.log(log_iteration)
+        self._log_step_profile(self.vrb, iteration)
+        # Begin training only when we have enough history
+        if self.history_manager.hist_len() >= self.configs["minhist"] and item_added:
+            self.observe()
+            # anneal epsilon, once for every game stepped
+            if self.configs["epsilon"] > self.configs["final_epsilon"]:
+                self.configs["epsilon"] -= self.vrb.num_envs * (self.configs["initial_epsilon"] -
+                                                               self.configs["final_epsilon"]) / \
+                                           self.configs["explore_steps"]
+            logs = [Log("epsilon", "{}".format(self.configs["epsilon"]), LOG_LEVEL_ALL)]
+            self.l.log(logs)
+            if iteration % 100000 == 0:
+                self._save_progress()
+            if iteration % 10000 == 0:
+                self.target_model.set_weights(self.model.get_weights())
+
+    def _run_step(self):
+        action_indexes = self.predict()
+        rewards, terminals = self.act(action_indexes)
+
+    def _play_key_callback(self, event):
+        """Callback for keys pressed during playing"""
+        if event.char == 'q' or event.char == 'Q':
+            self.vrb.quit_the_game()
+            exit()
+        elif event.char == 'r' or event.char == 'R':
+            self.ui.cancel_timer(self._pending_action)
+            self.vrb.reset()
+            self._reinit()
+            self._pending_action = self.ui.on_timer_end(100, self._run_callback)
+
+
 class QLearnerAgentOnTrial(QLearnerAgent):
 
     def __init__(self, configs):
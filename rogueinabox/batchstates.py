@@ -0,0 +1,263 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compute the states of recorded screens offline, many screens at a time.
+
+    states = compute_states_batch("M_P_D_S_Sn_StateGenerator", screens, player_pos, stairs_pos,
+                                  past_positions, new_game, processes=4)
+
+gives the same states the generator computed while the screens were played,
+so the history can be rebuilt for a different state generator without playing again."""
+
+import multiprocessing
+import numpy as np
+
+import states
+from glyphindex import GLYPH_CLASSES, BLANK, WALL, DOOR, PLAYER
+from rogueinabox import RogueBox
+
+
+def _positions_array(positions, length):
+    """return the (T, 2) array of the given positions, (-1, -1) where there is none"""
+    if isinstance(positions, np.ndarray):
+        return positions.astype(np.int64, copy=False)
+    array = np.full((length, 2), -1, dtype=np.int64)
+    for t, pos in enumerate(positions):
+        if pos:
+            array[t] = pos
+    return array
+
+
+def _past_positions_array(past_positions, length):
+    """return the (T, K, 2) array of the past positions of every step, padded with (-1, -1)"""
+    if isinstance(past_positions, np.ndarray):
+        return past_positions.astype(np.int64, copy=False)
+    size = max((len(positions) for positions in past_positions), default=0)
+    array = np.full((length, size, 2), -1, dtype=np.int64)
+    for t, positions in enumerate(past_positions):
+        for k, pos in enumerate(positions):
+            if pos:
+                array[t, k] = pos
+    return array
+
+
+def parse_statusbars(screens):
+    """return which of the (T, 24, 80) screens are the map (see RogueBox.is_map_view()) and the dungeon
+    level each one shows, -1 where there is none"""
+    parse_statusbar_re = RogueBox._compile_statusbar_re()
+    map_view = np.zeros(len(screens), dtype=bool)
+    levels = np.full(len(screens), -1, dtype=np.int64)
+    for t, line in enumerate(screens[:, -1]):
+        parsed_statusbar = parse_statusbar_re.match(line.tobytes().decode("latin-1"))
+        if parsed_statusbar:
+            map_view[t] = True
+            if parsed_statusbar.group("dungeon_level"):
+                levels[t] = int(parsed_statusbar.group("dungeon_level"))
+    return map_view, levels
+
+
+class ScreenBatch:
+    """A sequence of recorded screens with what the layers need about each step.
+    screens is a (T, 24, 80) array of character codes (see rogueinabox.screen_to_array()),
+    player_pos and stairs_pos the RogueBox positions of each step (screen coordinates, None or
+    (-1, -1) if unknown), past_positions the RogueBox past positions of each step (a (T, K, 2)
+    array or a list of lists) and new_game is True on the first screen of each game"""
+
+    def __init__(self, screens, player_pos, stairs_pos, past_positions=None, new_game=None):
+        self.screens = np.asarray(screens, dtype=np.uint8)
+        self.length = len(self.screens)
+        self.classes = GLYPH_CLASSES[self.screens[:, 1:23]]
+        self.passable_mask = (self.classes != BLANK) & (self.classes != WALL)
+        self.doors_mask = self.classes == DOOR
+        self.player_pos = _positions_array(player_pos, self.length)
+        self.stairs_pos = _positions_array(stairs_pos, self.length)
+        self.past_positions = None
+        if past_positions is not None:
+            self.past_positions = _past_positions_array(past_positions, self.length)
+        self.new_game = np.zeros(self.length, dtype=bool) if new_game is None else np.asarray(new_game, dtype=bool)
+        self.map_view, self.levels = parse_statusbars(self.screens)
+
+    def tombstone(self, t):
+        """check if the screen of step t is the game over screen"""
+        screen = self.screens[t].tobytes()
+        return b"_______)" in screen or b"You quit" in screen
+
+    def screen_player_pos(self, t):
+        """the position of the last @ on the map of step t (map coordinates), None if there is none"""
+        players = np.flatnonzero(self.classes[t] == PLAYER)
+        if len(players) == 0:
+            return None
+        return divmod(int(players[-1]), self.classes.shape[2])
+
+
+# BATCH LAYER KERNELS
+# the same components of states.LAYER_KERNELS, computed for all the steps of a ScreenBatch.
+# A kernel writes its layer in the (T, layers, 22, 80) states and returns the
+# indexes of the steps whose state must be empty (e.g. the heatmap asked for a reset)
+
+def _set_positions(states_layer, positions, value):
+    steps = np.flatnonzero(positions[:, 0] >= 0)
+    states_layer[steps, positions[steps, 0] - 1, positions[steps, 1]] = value
+
+def _map_batch_kernel(states_batch, layer, batch):
+    states_batch[:, layer][batch.passable_mask] = 255
+
+def _player_batch_kernel(states_batch, layer, batch):
+    _set_positions(states_batch[:, layer], batch.player_pos, 255)
+
+def _doors_batch_kernel(states_batch, layer, batch):
+    states_batch[:, layer][batch.doors_mask] = 255
+
+def _stairs_batch_kernel(states_batch, layer, batch):
+    _set_positions(states_batch[:, layer], batch.stairs_pos, 255)
+
+def _snake_batch_kernel(states_batch, layer, batch):
+    if batch.past_positions is None:
+        raise ValueError("the snake layer needs the past positions of every step")
+    unit = 255/10
+    # the values of Sn_StateGenerator.set_snake_layer(), by position in the list
+    values = np.array([int((k+1)*unit) % 256 for k in range(batch.past_positions.shape[1])], dtype=np.uint8)
+    steps, ks = np.nonzero(batch.past_positions[:, :, 0] >= 0)
+    positions = batch.past_positions[steps, ks]
+    # the indexes are in step then list order, so on repeated positions the most recent value is kept
+    states_batch[steps, layer, positions[:, 0] - 1, positions[:, 1]] = values[ks]
+
+def _heatmap_batch_kernel(states_batch, layer, batch):
+    # the heatmap depends on the previous steps, it is computed one step at a time
+    # following H_StateGenerator.set_heatmap_layer()
+    heatmap = np.zeros((22, 80), dtype=np.uint8)
+    first_state = True
+    heatmap_level = None
+    empty_steps = []
+    for t in range(batch.length):
+        if batch.new_game[t]:
+            heatmap.fill(0)
+            first_state = True
+        if not batch.map_view[t]:
+            if batch.tombstone(t):
+                heatmap.fill(0)
+                first_state = True
+            continue
+        if batch.levels[t] >= 0 and batch.levels[t] != heatmap_level:
+            heatmap.fill(0)
+            first_state = True
+            heatmap_level = batch.levels[t]
+        player_pos = batch.screen_player_pos(t)
+        if first_state:
+            if player_pos:
+                heatmap[player_pos] = 1
+            first_state = False
+        elif player_pos:
+            i, j = player_pos
+            adjacent_pos = [(max(0, i-1), j), (i, max(0, j-1)), (min(21, i+1), j), (i, min(79, j+1))]
+            passable_mask = batch.passable_mask[t]
+            update = min([heatmap[pos] for pos in adjacent_pos if passable_mask[pos]], default=0)
+            heatmap[player_pos] = update + 1
+            if heatmap[player_pos] >= 3:
+                empty_steps.append(t)
+                heatmap.fill(0)
+                first_state = True
+                continue
+        states_batch[t, layer] = heatmap
+    return empty_steps
+
+BATCH_LAYER_KERNELS = {
+    "M": _map_batch_kernel,
+    "P": _player_batch_kernel,
+    "D": _doors_batch_kernel,
+    "S": _stairs_batch_kernel,
+    "Sn": _snake_batch_kernel,
+    "H": _heatmap_batch_kernel,
+}
+
+
+def _layers_of(generator):
+    """return the layers of a state generator given by name ("M_P_D_StateGenerator"), layout ("M_P_D") or class"""
+    if isinstance(generator, str):
+        if generator.endswith("_StateGenerator"):
+            generator = getattr(states, generator)
+        else:
+            return states.parse_layers(generator)
+    if not issubclass(generator, states.LayeredStateGenerator):
+        raise ValueError("{} is not a layered state generator".format(generator.__name__))
+    return generator.layers
+
+
+def encode_ascii_to_int(screens):
+    """return the (T, 1, 22, 80) AsciiToIntStateGenerator states of the (T, 24, 80) screens"""
+    screens = np.asarray(screens, dtype=np.uint8)
+    table = states.AsciiToIntStateGenerator._init_numeric_table(states.AsciiToIntStateGenerator._init_numeric_map())
+    states_batch = table[screens[:, None, 1:23, :]]
+    states_batch[~parse_statusbars(screens)[0]] = 0
+    return states_batch
+
+
+def _compute_chunk(layers, screens, player_pos, stairs_pos, past_positions, new_game):
+    batch = ScreenBatch(screens, player_pos, stairs_pos, past_positions, new_game)
+    states_batch = np.zeros((batch.length, len(layers), 22, 80), dtype=np.uint8)
+    empty_steps = []
+    for layer, components in enumerate(layers):
+        for component in components:
+            empty_steps += BATCH_LAYER_KERNELS[component](states_batch, layer, batch) or []
+    # the game over and unknown states are empty too
+    states_batch[~batch.map_view] = 0
+    states_batch[empty_steps] = 0
+    return states_batch
+
+
+def _chunk_bounds(length, chunks, starts=None):
+    """split range(length) in about 'chunks' chunks, starting only at the given 'starts' if any"""
+    bounds = [int(bound) for bound in np.linspace(0, length, chunks + 1)]
+    if starts is not None:
+        starts = np.append(starts, length)
+        bounds = [int(starts[np.searchsorted(starts, bound)]) for bound in bounds]
+        bounds[0] = 0
+    return sorted(set(bounds))
+
+
+def compute_states_batch(generator, screens, player_pos, stairs_pos, past_positions=None, new_game=None,
+                         processes=1, chunk_size=10000):
+    """return the (T, layers, 22, 80) states of the recorded (T, 24, 80) screens, see ScreenBatch.
+    'generator' is a layered state generator (class, class name or layout such as "M_P_DS_H")
+    or the AsciiToIntStateGenerator.
+    With processes > 1 the screens are split in chunks of about chunk_size steps computed in parallel;
+    for layouts with a heatmap the chunks start at a new game, so new_game must be given"""
+    if generator in ("AsciiToIntStateGenerator", states.AsciiToIntStateGenerator):
+        # one table lookup, no metadata needed
+        return encode_ascii_to_int(screens)
+    layers = _layers_of(generator)
+    screens = np.asarray(screens, dtype=np.uint8)
+    length = len(screens)
+    player_pos = _positions_array(player_pos, length)
+    stairs_pos = _positions_array(stairs_pos, length)
+    if past_positions is not None:
+        past_positions = _past_positions_array(past_positions, length)
+    if processes <= 1 or length <= chunk_size:
+        return _compute_chunk(layers, screens, player_pos, stairs_pos, past_positions, new_game)
+
+    starts = None
+    if any("H" in components for components in layers):
+        if new_game is None:
+            raise ValueError("heatmap layouts can be computed in parallel only if new_game is given")
+        starts = np.flatnonzero(new_game)
+    bounds = _chunk_bounds(length, max(1, length // chunk_size), starts)
+    chunks = [(layers, screens[first:last], player_pos[first:last], stairs_pos[first:last],
+               None if past_positions is None else past_positions[first:last],
+               None if new_game is None else new_game[first:last])
+              for first, last in zip(bounds[:-1], bounds[1:])]
+    with multiprocessing.Pool(processes) as pool:
+        return np.concatenate(pool.starmap(_compute_chunk, chunks))
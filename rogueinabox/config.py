@@ -37,6 +37,15 @@ class ConfigurationManager:
                 "remote_debug": True,
                 "gui": False,
                 "gui_delay": 100,
+                "refresh_timeout": 0.5,
+                "settle_timeout": 0.003,
+                "num_envs": 1,
+                "num_workers": 1,
+                "rogue_pool_size": 0,
+                "startup_timeout": 2.0,
+                "terminal": "pyte",
+                "profile_steps": False,
+                "profile_every": 10000,
             },
             "State": {
                 "state_generator": "M_P_D_S_Sn_StateGenerator"
@@ -52,6 +61,15 @@ class ConfigurationManager:
                 "save_history": False,
                 "minhist": 5000,
                 "histsize": 100000,
+                "history_storage": "ring",
+                "history_dir": "assets/history",
+                "history_format": "pickle",
+                "history_chunk_size": 10000,
+                "history_compression": "zlib",
+                "priority_alpha": 0.6,
+                "priority_beta": 0.4,
+                "priority_epsilon": 0.01,
+                "stratum_proportions": "positive: 0.25, negative: 0.25",
                 "keep_balance": False
             },
             "Training": {
@@ -60,7 +78,9 @@ class ConfigurationManager:
                 "epsilon": 1,
                 "explore_steps": 500000,
                 "batchsize": 32,
+                "prefetch_batches": 0,
                 "gamma": 0.99,
+                "n_step": 1,
                 "only_legal_actions": False
             }
         }
@@ -93,9 +113,13 @@ class ConfigurationManager:
             else:
                 raise ConfigurationError("Config file '{}' could not be found.".format(self.args.config))
         sections = ["General", "State", "Model", "Reward", "History", "Training"]
-        int_options = ["verbose", "explore_steps", "minhist", "histsize", "batchsize", "gui_delay"]
-        float_options = ["initial_epsilon", "final_epsilon", "epsilon", "gamma"]
-        bool_options = ["gui", "keep_balance", "only_legal_actions", "save_history", "logsonfile", "remote_debug"]
+        int_options = ["verbose", "explore_steps", "minhist", "histsize", "batchsize", "gui_delay", "num_envs",
+                       "num_workers", "rogue_pool_size", "profile_every", "history_chunk_size",
+                       "prefetch_batches", "n_step"]
+        float_options = ["initial_epsilon", "final_epsilon", "epsilon", "gamma", "refresh_timeout", "settle_timeout",
+                         "startup_timeout", "priority_alpha", "priority_beta", "priority_epsilon"]
+        bool_options = ["gui", "keep_balance", "only_legal_actions", "save_history", "logsonfile", "remote_debug",
+                        "profile_steps"]
         config = configparser.ConfigParser()
         if config.read(config_file):
             try:
@@ -0,0 +1,89 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+# glyph classes
+OTHER = 0     # anything passable that is not listed below (floor, corridors, traps...)
+BLANK = 1
+WALL = 2
+DOOR = 3
+STAIRS = 4
+PLAYER = 5
+MONSTER = 6
+ITEM = 7
+
+MONSTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+ITEMS = "!*)]:?$=/,"
+
+
+def _build_glyph_classes():
+    """return a 256 entries table mapping each character code to its glyph class"""
+    classes = np.full(256, OTHER, dtype=np.uint8)
+    for chars, glyph_class in [(" ", BLANK), ("|-", WALL), ("+", DOOR), ("%", STAIRS), ("@", PLAYER),
+                               (MONSTERS, MONSTER), (ITEMS, ITEM)]:
+        for char in chars:
+            classes[ord(char)] = glyph_class
+    return classes
+
+
+class GlyphIndex:
+    """Everything the agents look for on a screen, found with a single pass over it.
+    Positions are in screen coordinates (row 0 is the message bar), the masks cover the
+    map section only (screen rows 1 to 22), so mask[i][j] is screen[i + 1][j].
+    Build it through RogueBox.get_glyph_index(), that keeps the index of recent screens"""
+
+    def __init__(self, screen, screen_array):
+        self.screen = screen
+        # the class of every cell of the screen
+        self.classes = GLYPH_CLASSES[screen_array]
+        map_classes = self.classes[1:23]
+        self.passable_mask = (map_classes != BLANK) & (map_classes != WALL)
+        self.doors_mask = map_classes == DOOR
+        self.monsters_mask = map_classes == MONSTER
+        self.items_mask = map_classes == ITEM
+        # number of non blank cells in the map section
+        self.non_blank = int(np.count_nonzero(map_classes != BLANK))
+        players = np.flatnonzero(map_classes == PLAYER)
+        # rogue may show more than one @ (e.g. on the tombstone),
+        # the player is the last one, some rewards use the first one
+        self.player_pos = self._to_screen_pos(players[-1]) if len(players) else None
+        self.first_player_pos = self._to_screen_pos(players[0]) if len(players) else None
+        stairs = np.flatnonzero(map_classes == STAIRS)
+        self.stairs_pos = self._to_screen_pos(stairs[-1]) if len(stairs) else None
+        self.tombstone = any("_______)" in line or "You quit" in line for line in screen)
+
+    def _to_screen_pos(self, flat_index):
+        i, j = divmod(int(flat_index), self.classes.shape[1])
+        return i + 1, j
+
+    @property
+    def doors_pos(self):
+        """the list of the doors positions"""
+        return [(int(i) + 1, int(j)) for i, j in np.argwhere(self.doors_mask)]
+
+    @property
+    def passable_pos(self):
+        """the list of the passable positions"""
+        return [(int(i) + 1, int(j)) for i, j in np.argwhere(self.passable_mask)]
+
+    def count_passables(self):
+        """count the passable cells of the whole screen, message and status bars included"""
+        return int(np.count_nonzero((self.classes != BLANK) & (self.classes != WALL)))
+
+
+GLYPH_CLASSES = _build_glyph_classes()
@@ -22,16 +22,48 @@ import random
 import numpy as np
 
 import os
+import queue
+import threading
 from collections import deque
 
+from replay import make_replay_store, SumTree, IndexSet
+from config import ConfigurationError
+import historychunks
+
+
+def apportion(shares, total):
+    """split total in integer parts proportional to shares (which add up to 1) with the
+    largest remainder method: each part is rounded down, then the parts with the largest
+    fractions get one more until the parts add up to total"""
+    quotas = np.asarray(shares, dtype=np.float64) * total
+    parts = np.floor(quotas).astype(np.int64)
+    missing = total - parts.sum()
+    if missing > 0:
+        parts[np.argsort(parts - quotas, kind="stable")[:missing]] += 1
+    return parts
+
 
 class HistoryManager(ABC):
-    """A class responsible for saving history and loading batch of it for training purposes."""
+    """A class responsible for saving history and loading batch of it for training purposes.
+    The transitions are kept in a replay store (see replay.py) of agent.configs["histsize"] entries,
+    chosen by agent.configs["history_storage"]; subclasses decide which transitions to store"""
 
     def __init__(self, agent):
         """Constructor for History"""
         self.agent = agent
-        self._history = None
+        self._history = make_replay_store(agent.configs)
+        # the number of transitions ever stored, to save only the new ones in chunks
+        self._stored = 0
+        # the value of _stored when each slot was written, tells the minibatches picked
+        # before a slot was overwritten (see pick_batch)
+        self._slot_versions = np.zeros(self._history.capacity, dtype=np.int64)
+        # held while the history changes or a batch is picked, see MinibatchPrefetcher
+        self.lock = threading.RLock()
+        # n-step returns: the steps of each game (stream) whose transition is not complete yet
+        self.n_step = agent.configs["n_step"]
+        self.gamma = agent.configs["gamma"]
+        self.discount = self.gamma ** self.n_step
+        self._pending = {}
 
     @property
     def history(self):
@@ -42,58 +74,137 @@ class HistoryManager(ABC):
         """Return the history length"""
         return len(self._history)
 
+    def _chunks_directory(self, filename):
+        return os.path.splitext(filename)[0] + "_chunks"
+
     def save_history_on_file(self, filename):
-        """Save the history on file"""
+        """Save the history on file, as a list of (old_state, action, reward, new_state, terminal) tuples,
+        the newest first. With agent.configs["history_format"] = "chunks" the transitions stored since
+        the last save are appended to the chunks directory of filename instead (see historychunks.py).
+        Histories kept on disk are only flushed"""
+        if self._history.persistent:
+            self._history.flush()
+            return
+        if self.agent.configs["history_format"] == "chunks":
+            print("Saving history chunks...")
+            historychunks.save_chunks(self._history, self._chunks_directory(filename), self._stored,
+                                      self.agent.configs["history_chunk_size"],
+                                      self.agent.configs["history_compression"])
+            print("History saved!")
+            return
         print("Saving history...")
         with open(filename, "wb") as history:
-            pickle.dump(self._history, history)
+            pickle.dump(list(self._history.transitions()), history)
             print("History saved!")
 
     def load_history_from_file(self, filename):
-        """Load the history from the filesystem"""
-        if os.path.isfile(filename):
+        """Load the history from the filesystem, unless it is kept on disk and was already resumed"""
+        if self._history.persistent and len(self._history) > 0:
+            print("History resumed from {}".format(self._history.directory))
+        elif self.agent.configs["history_format"] == "chunks":
+            print("Loading history chunks...")
+            self._stored = historychunks.load_chunks(self._store, self._chunks_directory(filename),
+                                                     self._history.capacity)
+            print("History loaded!")
+        elif os.path.isfile(filename):
             print("History found, loading...")
             with open(filename, "rb") as history:
-                self._history = pickle.load(history)
-                print("History loaded!")
+                transitions = pickle.load(history)
+            # the transitions are saved the newest first, histories saved as a deque are too
+            for transition in reversed(transitions):
+                self._store(*transition)
+            print("History loaded!")
+
+    def _store(self, old_state, action_index, reward, new_state, terminal, stream=0):
+        """store a transition in the history, return its index"""
+        with self.lock:
+            self._stored += 1
+            index = self._history.add(old_state, action_index, reward, new_state, terminal, stream)
+            self._slot_versions[index] = self._stored
+            return index
+
+    def _add_transition(self, action_index, reward, terminal):
+        """store the transition of the agent's last step, the states are copied in the history.
+        Agents playing more games at once tell which one the transition comes from with env_index.
+        With agent.configs["n_step"] = n > 1 the transition is stored n steps later, when its
+        reward is the discounted sum of the next n rewards and its new state the one n steps ahead,
+        or when the game ends"""
+        stream = getattr(self.agent, "env_index", 0)
+        if self.n_step == 1:
+            return self._store(self.agent.old_state, action_index, reward, self.agent.state, terminal, stream)
+        self._push_step(stream, action_index, reward, terminal, True)
+
+    def _skip_transition(self, action_index, reward, terminal):
+        """called instead of _add_transition() for the steps whose transition is not stored,
+        n-step returns still need their reward"""
+        if self.n_step > 1:
+            self._push_step(getattr(self.agent, "env_index", 0), action_index, reward, terminal, False)
+
+    def _push_step(self, stream, action_index, reward, terminal, keep):
+        # each pending step is [old state, action, return, steps summed in the return, whether to store it]
+        pending = self._pending.setdefault(stream, deque())
+        for step in pending:
+            step[2] += self.gamma ** step[3] * reward
+            step[3] += 1
+        pending.append([np.copy(self.agent.old_state), action_index, reward, 1, keep])
+        if terminal:
+            # the game is over, the returns of all the pending steps are complete
+            while pending:
+                self._store_step(pending.popleft(), True, stream)
+        elif len(pending) == self.n_step:
+            self._store_step(pending.popleft(), False, stream)
+
+    def end_game(self, stream=None):
+        """Called when a game restarts without a terminal transition (e.g. the agent reset it),
+        drop the pending n-step steps of that game (stream), of all the games if stream is None,
+        so that no return spans two games"""
+        if stream is None:
+            self._pending.clear()
+        else:
+            self._pending.pop(stream, None)
+
+    def _store_step(self, step, terminal, stream):
+        old_state, action_index, n_step_return, _, keep = step
+        if keep:
+            self._store(old_state, action_index, n_step_return, self.agent.state, terminal, stream)
 
     @abstractmethod
     def update_history(self):
         """Method responsible for saving the new state into the history"""
         pass
 
-    @abstractmethod
-    def pick_batch(self):
-        """Method responsible for picking a batch of states from the history to train"""
+    def pick_batch(self, batch_dimension):
+        """Return a Minibatch of batch_dimension transitions picked from the history, see _pick_batch().
+        The discount of the next states is gamma ** n_step, for all the transitions (the ones
+        that end a game have no next state). The versions of the slots are to be passed back
+        to update_priorities(), which skips the slots written since the pick"""
+        minibatch = self._pick_batch(batch_dimension)
+        return minibatch._replace(discounts=np.full(batch_dimension, self.discount, dtype=np.float32),
+                                  versions=self._slot_versions[minibatch.indices])
+
+    def _pick_batch(self, batch_dimension):
+        """Return a Minibatch of batch_dimension transitions picked at random from the history"""
+        return self._history.sample(batch_dimension)
+
+    def update_priorities(self, indices, td_errors, versions=None):
+        """Called after training on a minibatch with the TD errors of its transitions
+        and the versions of its slots (see pick_batch)"""
         pass
 
 
 class FIFORandomPickHM(HistoryManager):
     """Simple fifo queue history implementation"""
 
-    def __init__(self, agent):
-        super().__init__(agent)
-        self._history = deque()
-
     def update_history(self, action_index, reward, terminal):
         """Update the fifo history queue
         return True if an item was added, False otherwise
         """
-        self._history.appendleft((self.agent.old_state, action_index, reward, self.agent.state, terminal))
-        if len(self._history) > self.agent.configs["histsize"]:
-            self._history.pop()
+        self._add_transition(action_index, reward, terminal)
         return True
 
-    def pick_batch(self, batch_dimension):
-        return random.sample(list(self._history), batch_dimension)
-
 class NearDoorRandomPickHM(HistoryManager):
     """A more balanced history implementation for ExitRoom"""
 
-    def __init__(self, agent):
-        super().__init__(agent)
-        self._history = deque()
-
     def _distance_from_door(self, state):
         # warning: the rogue may cover the door
         rogue_pos = np.argwhere(state[1] == 255)
@@ -115,56 +226,221 @@ class NearDoorRandomPickHM(HistoryManager):
         """
         item_added = False
         if (reward > 0) or (random.random() < self._distance_from_door(self.agent.state[0])**-2.):  
-            self._history.appendleft((self.agent.old_state, action_index, reward, self.agent.state, terminal))
+            self._add_transition(action_index, reward, terminal)
             item_added = True
-        if len(self._history) > self.agent.configs["histsize"]:
-            self._history.pop()
+        else:
+            self._skip_transition(action_index, reward, terminal)
         return item_added
 
-    def pick_batch(self, batch_dimension):
-        return random.sample(list(self._history), batch_dimension)
-
 class StatisticBalanceRandomPickHM(HistoryManager):
     """Simple balanced history implementation"""
 
-    def __init__(self, agent):
-        super().__init__(agent)
-        self._history = deque()
-
     def update_history(self, action_index, reward, terminal):
         """Update the balanced history queue
         return True if an item was added, False otherwise
         """
         item_added = False
         if (reward >= 0) or (self.agent.configs["iteration"] % 7 == 0):
-            self._history.appendleft((self.agent.old_state, action_index, reward, self.agent.state, terminal))
+            self._add_transition(action_index, reward, terminal)
             item_added = True
-        if len(self._history) > self.agent.configs["histsize"]:
-            self._history.pop()
+        else:
+            self._skip_transition(action_index, reward, terminal)
         return item_added
 
-    def pick_batch(self, batch_dimension):
-        return random.sample(list(self._history), batch_dimension)
-
 
 class StatisticBalance2RandomPickHM(HistoryManager):
     """Simple balanced history implementation"""
 
-    def __init__(self, agent):
-        super().__init__(agent)
-        self._history = deque()
-
     def update_history(self, action_index, reward, terminal):
         """Update the balanced history queue
         return True if an item was added, False otherwise
         """
         item_added = False
         if reward > 0 or (reward < 0 and random.random() < 0.2):
-            self._history.appendleft((self.agent.old_state, action_index, reward, self.agent.state, terminal))
+            self._add_transition(action_index, reward, terminal)
             item_added = True
-        if len(self._history) > self.agent.configs["histsize"]:
-            self._history.pop()
+        else:
+            self._skip_transition(action_index, reward, terminal)
         return item_added
 
-    def pick_batch(self, batch_dimension):
-        return random.sample(list(self._history), batch_dimension)
+
+class PrioritizedHM(HistoryManager):
+    """Prioritized experience replay: every transition is stored, transitions are picked with
+    probability proportional to (|TD error| + priority_epsilon) ** priority_alpha and weighted by
+    (N * probability) ** -priority_beta (normalized by the largest weight) to correct the bias.
+    New transitions get the largest priority seen, so they are picked at least once"""
+
+    # the lowest priority of a stored transition, with priority_epsilon = 0 a TD error of 0
+    # would make it unpickable, and the weight of a zero priority is infinite
+    min_priority = 1e-6
+
+    def __init__(self, agent):
+        super().__init__(agent)
+        self.alpha = agent.configs["priority_alpha"]
+        self.beta = agent.configs["priority_beta"]
+        self.epsilon = agent.configs["priority_epsilon"]
+        self._priorities = SumTree(self._history.capacity)
+        self._max_priority = 1.0
+        self._history.on_evict = self._on_evict
+        # a history resumed from disk starts with uniform priorities
+        if len(self._history) > 0:
+            self._priorities.update(self._history.ordered_indices(), self._max_priority)
+
+    def _on_evict(self, index):
+        self._priorities.update([index], 0.0)
+        # the slot no longer holds the transition a minibatch may have picked
+        self._slot_versions[index] = -1
+
+    def _store(self, old_state, action_index, reward, new_state, terminal, stream=0):
+        with self.lock:
+            index = super()._store(old_state, action_index, reward, new_state, terminal, stream)
+            self._priorities.update([index], self._max_priority)
+            return index
+
+    def update_history(self, action_index, reward, terminal):
+        """Update the prioritized history
+        return True if an item was added, False otherwise
+        """
+        self._add_transition(action_index, reward, terminal)
+        return True
+
+    def _pick_batch(self, batch_dimension):
+        # one pick in each of batch_dimension equal segments of the total priority
+        total = self._priorities.total
+        values = (np.arange(batch_dimension) + np.random.random(batch_dimension)) * (total / batch_dimension)
+        indices = self._priorities.find(values)
+        # a pick can still land on an empty slot through rounding errors
+        probabilities = np.maximum(self._priorities.get(indices), self.min_priority) / total
+        weights = (len(self._history) * probabilities) ** -self.beta
+        return self._history.get(indices)._replace(weights=(weights / weights.max()).astype(np.float32))
+
+    def update_priorities(self, indices, td_errors, versions=None):
+        priorities = np.maximum((np.abs(td_errors) + self.epsilon) ** self.alpha, self.min_priority)
+        with self.lock:
+            if versions is not None:
+                # a prefetched minibatch may be older than the transitions now in its slots
+                current = self._slot_versions[indices] == versions
+                indices, priorities = np.asarray(indices)[current], priorities[current]
+            if len(priorities) > 0:
+                self._priorities.update(indices, priorities)
+                self._max_priority = max(self._max_priority, float(priorities.max()))
+
+
+class StratifiedHM(HistoryManager):
+    """Balances the batches when they are picked instead of dropping transitions: every transition
+    is stored and kept in the index sets of its strata, i.e. positive, negative or zero (reward),
+    terminal and action<i> (e.g. action0 for actions[0]).
+    agent.configs["stratum_proportions"] tells which share of each batch comes from some strata,
+    e.g. "positive: 0.25, negative: 0.25"; the rest of the batch, and the shares of the strata
+    that are still empty, are picked from the whole history"""
+
+    def __init__(self, agent):
+        super().__init__(agent)
+        self.proportions = self._parse_proportions(agent.configs["stratum_proportions"])
+        capacity = self._history.capacity
+        self._strata = {stratum: IndexSet(capacity) for stratum in self.proportions}
+        # the strata each slot is in
+        self._slot_strata = [() for _ in range(capacity)]
+        self._history.on_evict = self._on_evict
+        # a history resumed from disk
+        for index in self._history.ordered_indices():
+            self._index(index, self._history.rewards[index], self._history.actions[index],
+                        self._history.terminals[index])
+
+    @staticmethod
+    def _parse_proportions(proportions):
+        parsed = {}
+        for item in proportions.split(","):
+            if item.strip():
+                stratum, share = item.split(":")
+                stratum = stratum.strip()
+                if stratum not in ("positive", "negative", "zero", "terminal") and \
+                        not (stratum.startswith("action") and stratum[6:].isdigit()):
+                    raise ConfigurationError("Unknown stratum '{}' in stratum_proportions.".format(stratum))
+                parsed[stratum] = float(share)
+        if sum(parsed.values()) > 1:
+            raise ConfigurationError("The stratum proportions add up to more than 1.")
+        return parsed
+
+    def _strata_of(self, reward, action_index, terminal):
+        strata = ["positive" if reward > 0 else "negative" if reward < 0 else "zero", "action{}".format(action_index)]
+        if terminal:
+            strata.append("terminal")
+        return [stratum for stratum in strata if stratum in self._strata]
+
+    def _index(self, index, reward, action_index, terminal):
+        self._on_evict(index)
+        self._slot_strata[index] = self._strata_of(reward, action_index, terminal)
+        for stratum in self._slot_strata[index]:
+            self._strata[stratum].add(index)
+
+    def _on_evict(self, index):
+        for stratum in self._slot_strata[index]:
+            self._strata[stratum].discard(index)
+        self._slot_strata[index] = ()
+
+    def _store(self, old_state, action_index, reward, new_state, terminal, stream=0):
+        with self.lock:
+            index = super()._store(old_state, action_index, reward, new_state, terminal, stream)
+            # the slot of a ring store may hold an older transition
+            self._index(index, reward, action_index, terminal)
+            return index
+
+    def update_history(self, action_index, reward, terminal):
+        """Update the stratified history
+        return True if an item was added, False otherwise
+        """
+        self._add_transition(action_index, reward, terminal)
+        return True
+
+    def _pick_batch(self, batch_dimension):
+        strata = [stratum for stratum in self.proportions if len(self._strata[stratum]) > 0]
+        shares = [self.proportions[stratum] for stratum in strata]
+        # the last part is picked from the whole history
+        counts = apportion(shares + [max(0.0, 1 - sum(shares))], batch_dimension)
+        picked = [self._strata[stratum].sample(count) for stratum, count in zip(strata, counts)]
+        if counts[-1] > 0:
+            picked.append(self._history.sample_indices(counts[-1]))
+        return self._history.get(np.concatenate(picked))
+
+
+class MinibatchPrefetcher:
+    """Picks minibatches from a history manager in a background thread, so that sampling and
+    stacking them overlap with the game steps and the training. Up to depth minibatches are kept
+    ready, with the states as contiguous float32 arrays; the thread starts on the first get()
+    and stops on close(). Prefetched minibatches do not include the transitions stored after
+    they were picked (nor the latest priorities, for PrioritizedHM), and their versions keep
+    update_priorities() from touching the slots overwritten since"""
+
+    def __init__(self, history_manager, batch_dimension, depth=2):
+        self.history_manager = history_manager
+        self.batch_dimension = batch_dimension
+        self._queue = queue.Queue(maxsize=depth)
+        self._thread = None
+        self._closed = False
+
+    def _run(self):
+        while not self._closed:
+            with self.history_manager.lock:
+                minibatch = self.history_manager.pick_batch(self.batch_dimension)
+            minibatch = minibatch._replace(states=np.ascontiguousarray(minibatch.states, dtype=np.float32),
+                                           next_states=np.ascontiguousarray(minibatch.next_states, dtype=np.float32))
+            self._queue.put(minibatch)
+
+    def get(self):
+        """return the next minibatch"""
+        if self._thread is None:
+            # the thread dies with the agent
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self._queue.get()
+
+    def close(self):
+        """stop the thread, the minibatches it prefetched are dropped"""
+        self._closed = True
+        if self._thread is not None:
+            # make room for the minibatch the thread may be putting, then it sees _closed and returns
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,114 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Append-only history files: a directory of compressed chunks of transitions plus index.json.
+
+Each save writes only the transitions added since the previous one, as new chunks of
+chunk_size transitions (the last chunk may be shorter, it is rewritten by the next save),
+then the index; a crash while saving leaves the previous index and chunks valid.
+Loading reads one chunk at a time and skips the chunks that would not fit in the replay store."""
+
+import io
+import json
+import lzma
+import os
+import zlib
+import numpy as np
+
+INDEX = "index.json"
+ARRAYS = ["states", "actions", "rewards", "next_states", "terminals"]
+COMPRESSORS = {"zlib": (zlib.compress, zlib.decompress), "lzma": (lzma.compress, lzma.decompress)}
+
+
+def read_index(directory):
+    """return the index of a chunks directory, None if there is none"""
+    try:
+        with open(os.path.join(directory, INDEX)) as index:
+            return json.load(index)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomically(path, data, mode="wb"):
+    with open(path + ".tmp", mode) as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def _write_chunk(path, minibatch, compression):
+    buffer = io.BytesIO()
+    np.savez(buffer, **{name: getattr(minibatch, name) for name in ARRAYS})
+    compress = COMPRESSORS[compression][0]
+    _write_atomically(path, compress(buffer.getvalue()))
+
+
+def read_chunk(directory, chunk, compression):
+    """return the arrays (see ARRAYS) of a chunk listed in the index"""
+    decompress = COMPRESSORS[compression][1]
+    with open(os.path.join(directory, chunk["file"]), "rb") as f:
+        arrays = np.load(io.BytesIO(decompress(f.read())))
+        return {name: arrays[name] for name in ARRAYS}
+
+
+def save_chunks(store, directory, added, chunk_size=10000, compression="zlib"):
+    """append to the chunks in directory the transitions of the replay store added since the last save.
+    added is the number of transitions ever added to the store (or loaded in it), the index
+    records how many of them are saved; the ones already dropped by the store are lost"""
+    os.makedirs(directory, exist_ok=True)
+    index = read_index(directory) or {"compression": compression, "chunk_size": chunk_size,
+                                      "transitions": 0, "chunks": []}
+    compression = index["compression"]
+    chunk_size = index["chunk_size"]
+    chunks = index["chunks"]
+    pending = added - index["transitions"]
+    # the last chunk is rewritten with the new transitions if it is short and they are all still stored
+    if chunks and chunks[-1]["transitions"] < chunk_size and pending + chunks[-1]["transitions"] <= len(store):
+        pending += chunks.pop()["transitions"]
+    pending = min(pending, len(store))
+    if pending <= 0:
+        return
+    # the newest transitions, the oldest first
+    indices = store.ordered_indices()[:pending][::-1]
+    for first in range(0, pending, chunk_size):
+        chunk = {"file": "chunk_{:06d}.npz.{}".format(len(chunks), compression),
+                 "transitions": len(indices[first:first + chunk_size])}
+        _write_chunk(os.path.join(directory, chunk["file"]), store.get(indices[first:first + chunk_size]),
+                     compression)
+        chunks.append(chunk)
+    index["transitions"] = added
+    _write_atomically(os.path.join(directory, INDEX), json.dumps(index, indent=1), mode="w")
+
+
+def load_chunks(add, directory, capacity=None):
+    """call add(old_state, action, reward, new_state, terminal) on the saved transitions, the oldest first,
+    reading one chunk at a time. If capacity is given only the last capacity transitions are read.
+    Return the number of transitions the index records as saved, 0 if there is no index"""
+    index = read_index(directory)
+    if index is None:
+        return 0
+    chunks = index["chunks"]
+    skip = sum(chunk["transitions"] for chunk in chunks) - capacity if capacity is not None else 0
+    for chunk in chunks:
+        if skip >= chunk["transitions"]:
+            skip -= chunk["transitions"]
+            continue
+        arrays = read_chunk(directory, chunk, index["compression"])
+        for i in range(max(skip, 0), chunk["transitions"]):
+            add(arrays["states"][i], int(arrays["actions"][i]), float(arrays["rewards"][i]),
+                arrays["next_states"][i], bool(arrays["terminals"][i]))
+        skip = 0
+    return index["transitions"]
@@ -112,7 +112,7 @@ class SimpleExplorationJudge(Judge):
         if self.level is None:
             # this will happen at game_over
             self.level = self.old_level
-        if self.level > self.old_level:
+        if self.old_level is not None and self.level is not None and self.level > self.old_level:
             self.score += self.rb._count_passables_in_screen(self.old_screen)
 
     def hook_game_over(self):
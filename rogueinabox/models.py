@@ -71,8 +71,7 @@ class ModelReshaper(ABC):
 
     def _check_shape(self):
         """Check if the states provided in rogueinabox are compatible with this model."""
-        state_generator = self.rb.state_generator
-        if not self._shape == state_generator.shape:
+        if not self._shape == self.rb.get_state_shape():
             raise IncompatibleStateError()
 
     @abstractmethod
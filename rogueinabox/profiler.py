@@ -0,0 +1,121 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect
+from time import perf_counter
+
+# the stages of a RogueBox step, in execution order
+STEP_STAGES = ["write", "wait", "read", "feed", "dismiss", "positions", "reward", "state", "terminal"]
+
+# upper bounds (in seconds) of the histogram buckets, the last bucket has no upper bound
+BUCKETS = [1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1]
+
+
+class StepProfiler:
+    """Measure how long each stage of a step takes.
+    Call start_step() when a step begins, mark(stage) when a stage ends (the stage lasted
+    since the previous mark) and end_step() when the step is over. The time of each stage
+    is summed over the step, then added to the stage total and histogram.
+    Steps started while another one is running (e.g. the commands sent to dismiss a message)
+    are not measured on their own, their time goes to the stage of the outer step"""
+
+    def __init__(self, stages=STEP_STAGES):
+        self.stages = list(stages)
+        self.reset()
+
+    def reset(self):
+        """forget the collected timings"""
+        self.steps = 0
+        self.totals = dict.fromkeys(self.stages, 0.0)
+        self.histograms = {stage: [0] * (len(BUCKETS) + 1) for stage in self.stages}
+        self._step = dict.fromkeys(self.stages, 0.0)
+        self._depth = 0
+        self._last = 0.0
+
+    def start_step(self):
+        self._depth += 1
+        if self._depth == 1:
+            self._last = perf_counter()
+
+    def mark(self, stage):
+        if self._depth == 1:
+            now = perf_counter()
+            self._step[stage] += now - self._last
+            self._last = now
+
+    def end_step(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.steps += 1
+            step = self._step
+            for stage in self.stages:
+                elapsed = step[stage]
+                self.totals[stage] += elapsed
+                self.histograms[stage][bisect(BUCKETS, elapsed)] += 1
+                step[stage] = 0.0
+
+    def get_profile(self):
+        """return {"steps": measured steps, "stages": {stage: {"total", "mean", "histogram"}}}.
+        Times are in seconds, histogram[i] counts the steps in which the stage took
+        less than BUCKETS[i] (and at least BUCKETS[i-1])"""
+        steps = max(self.steps, 1)
+        return {
+            "steps": self.steps,
+            "stages": {stage: {"total": self.totals[stage],
+                               "mean": self.totals[stage] / steps,
+                               "histogram": self.histograms[stage][:]}
+                       for stage in self.stages},
+        }
+
+
+class NullProfiler(StepProfiler):
+    """a StepProfiler that measures nothing, used when profiling is disabled"""
+
+    def start_step(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end_step(self):
+        pass
+
+
+def format_profile(profile):
+    """return a one line summary of a profile returned by StepProfiler.get_profile()"""
+    stages = profile["stages"]
+    total = sum(stage["mean"] for stage in stages.values())
+    parts = ["{}: {:.3f}".format(name, stage["mean"] * 1000) for name, stage in stages.items()]
+    return "step profile over {} steps, {:.3f} ms per step ({} ms)".format(
+        profile["steps"], total * 1000, ", ".join(parts))
+
+
+def merge_profiles(profiles):
+    """return the profile of all the steps measured in the given profiles"""
+    profiles = list(profiles)
+    steps = sum(profile["steps"] for profile in profiles)
+    merged = {"steps": steps, "stages": {}}
+    for profile in profiles:
+        for name, stage in profile["stages"].items():
+            if name not in merged["stages"]:
+                merged["stages"][name] = {"total": 0.0, "mean": 0.0, "histogram": [0] * len(stage["histogram"])}
+            merged_stage = merged["stages"][name]
+            merged_stage["total"] += stage["total"]
+            merged_stage["histogram"] = [a + b for a, b in zip(merged_stage["histogram"], stage["histogram"])]
+    for stage in merged["stages"].values():
+        stage["mean"] = stage["total"] / max(steps, 1)
+    return merged
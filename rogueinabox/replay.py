@@ -0,0 +1,346 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque, namedtuple
+import json
+import numpy as np
+import os
+
+# a batch of transitions, each field stacks the values of all the transitions;
+# indices are the positions of the transitions in the replay store,
+# weights the importance sampling weights of the transitions (None if they were picked uniformly),
+# discounts the factors of the value of next_states in the targets (gamma ** n for n-step returns),
+# versions tell which transitions the slots held when the batch was picked (see HistoryManager.pick_batch)
+Minibatch = namedtuple("Minibatch", ["states", "actions", "rewards", "next_states", "terminals", "indices", "weights",
+                                     "discounts", "versions"], defaults=[None, None, None])
+
+
+class RingReplay:
+    """Fixed size store of transitions (old_state, action, reward, new_state, terminal)
+    kept in preallocated arrays. When it is full a new transition replaces the oldest one.
+    The arrays are allocated on the first add(), when the state shape and type are known"""
+
+    # whether the store is kept on disk as it is filled, see MemmapReplay
+    persistent = False
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # called with the index of every transition dropped before its slot is reused, if set
+        self.on_evict = None
+        self._size = 0
+        # where the next transition goes
+        self._next = 0
+        self.states = None
+        self.next_states = None
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.terminals = np.zeros(capacity, dtype=bool)
+        # Generator.choice picks without replacement in O(batch), np.random.choice shuffles the whole range
+        self._rng = np.random.default_rng()
+
+    def __len__(self):
+        return self._size
+
+    def _allocate(self, state):
+        self.states = np.zeros((self.capacity,) + state.shape, dtype=state.dtype)
+        self.next_states = np.zeros((self.capacity,) + state.shape, dtype=state.dtype)
+
+    def add(self, old_state, action, reward, new_state, terminal, stream=0):
+        """store a transition (the states are copied), return its index.
+        stream tells apart the games played at the same time, see DedupReplay"""
+        if self.states is None:
+            self._allocate(np.asarray(old_state))
+        index = self._next
+        self.states[index] = old_state
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.next_states[index] = new_state
+        self.terminals[index] = terminal
+        self._next = (index + 1) % self.capacity
+        self._size = min(self._size + 1, self.capacity)
+        return index
+
+    def sample_indices(self, batch_size):
+        """return batch_size distinct random indices of stored transitions"""
+        return self._rng.choice(self._size, batch_size, replace=False)
+
+    def get(self, indices):
+        """return the transitions at the given indices as a Minibatch"""
+        return Minibatch(self.states[indices], self.actions[indices], self.rewards[indices],
+                         self.next_states[indices], self.terminals[indices], indices)
+
+    def sample(self, batch_size):
+        """return a Minibatch of batch_size random transitions"""
+        return self.get(self.sample_indices(batch_size))
+
+    def ordered_indices(self):
+        """return the indices of the stored transitions, the newest first"""
+        return (self._next - 1 - np.arange(self._size)) % self.capacity
+
+    def transitions(self):
+        """iterate over the stored transitions as tuples, the newest first"""
+        for index in self.ordered_indices():
+            yield (self.states[index], int(self.actions[index]), float(self.rewards[index]),
+                   self.next_states[index], bool(self.terminals[index]))
+
+
+# how many frames back DedupReplay looks for the old state of a transition
+DEDUP_REUSE_WINDOW = 256
+
+
+class DedupReplay(RingReplay):
+    """A RingReplay that keeps every state once: the new state of a transition is usually the
+    old state of a later transition of the same game (stream), the next one or, with n-step
+    returns, the one lookback transitions later. So the old state is stored only when it is not
+    among the new frames of the last lookback transitions of the stream (e.g. a new game started,
+    or the history manager skipped some transitions). Transitions are indices in a ring of frames.
+
+    The frames ring holds capacity + 1 + DEDUP_REUSE_WINDOW frames, enough for capacity transitions
+    of a single game; when transitions need two new frames fewer transitions are kept. Frames are reused only if they were stored in the
+    last DEDUP_REUSE_WINDOW frames, and a transition is evicted as soon as the frames stored from
+    its insertion on fill the ring minus the window; this way every kept transition points to
+    frames that were not overwritten"""
+
+    def __init__(self, capacity, reuse_window=DEDUP_REUSE_WINDOW, lookback=1):
+        super().__init__(capacity)
+        self.reuse_window = reuse_window
+        self.lookback = lookback
+        self.frames_capacity = capacity + 1 + reuse_window
+        self.frames = None
+        # frame numbers are absolute, frame n is in frames[n % frames_capacity]
+        self._frames_stored = 0
+        self.old_frames = np.zeros(capacity, dtype=np.int64)
+        self.new_frames = np.zeros(capacity, dtype=np.int64)
+        # the number of frames stored before each transition
+        self._anchors = np.zeros(capacity, dtype=np.int64)
+        # the oldest transition
+        self._first = 0
+        # the new frames of the last lookback transitions of each stream, the oldest first
+        self._last_frames = {}
+
+    def _allocate(self, state):
+        self.frames = np.zeros((self.frames_capacity,) + state.shape, dtype=state.dtype)
+
+    def _store_frame(self, state):
+        frame = self._frames_stored
+        self.frames[frame % self.frames_capacity] = state
+        self._frames_stored += 1
+        return frame
+
+    def _evict_oldest(self):
+        if self.on_evict is not None:
+            self.on_evict(self._first)
+        self._first = (self._first + 1) % self.capacity
+        self._size -= 1
+
+    def add(self, old_state, action, reward, new_state, terminal, stream=0):
+        """store a transition (the states are copied unless already stored), return its index"""
+        if self.frames is None:
+            self._allocate(np.asarray(old_state))
+        anchor = self._frames_stored
+        last_frames = self._last_frames.setdefault(stream, deque(maxlen=self.lookback))
+        # the oldest first, with n-step returns it is the one that matches
+        old_frame = next((frame for frame in last_frames if frame >= anchor - self.reuse_window and
+                          np.array_equal(self.frames[frame % self.frames_capacity], old_state)), None)
+        if old_frame is None:
+            old_frame = self._store_frame(old_state)
+        new_frame = self._store_frame(new_state)
+        # no later transition starts from the final state; the pending n-step transitions
+        # of the game, stored right after this one, still start from the frames before it
+        if not terminal:
+            last_frames.append(new_frame)
+
+        if self._size == self.capacity:
+            self._evict_oldest()
+        index = (self._first + self._size) % self.capacity
+        self.old_frames[index] = old_frame
+        self.new_frames[index] = new_frame
+        self._anchors[index] = anchor
+        self.actions[index] = action
+        self.rewards[index] = reward
+        self.terminals[index] = terminal
+        self._size += 1
+        # drop the transitions whose frames may have been overwritten
+        oldest_anchor = self._frames_stored - self.frames_capacity + self.reuse_window
+        while self._anchors[self._first] < oldest_anchor:
+            self._evict_oldest()
+        return index
+
+    def sample_indices(self, batch_size):
+        return (self._first + self._rng.choice(self._size, batch_size, replace=False)) % self.capacity
+
+    def get(self, indices):
+        return Minibatch(self.frames[self.old_frames[indices] % self.frames_capacity], self.actions[indices],
+                         self.rewards[indices], self.frames[self.new_frames[indices] % self.frames_capacity],
+                         self.terminals[indices], indices)
+
+    def ordered_indices(self):
+        return (self._first + self._size - 1 - np.arange(self._size)) % self.capacity
+
+    def transitions(self):
+        for index in self.ordered_indices():
+            yield (self.frames[self.old_frames[index] % self.frames_capacity], int(self.actions[index]),
+                   float(self.rewards[index]), self.frames[self.new_frames[index] % self.frames_capacity],
+                   bool(self.terminals[index]))
+
+
+class MemmapReplay(RingReplay):
+    """A RingReplay whose arrays are memory mapped .npy files in a directory, so histories larger
+    than the ram can be kept (the system pages them in when sampled) and a run can go on with the
+    history of the previous one without loading it. header.json records how much of the ring is
+    filled and is written by flush(); with resume=False the files are created anew"""
+
+    persistent = True
+    arrays = ["states", "next_states", "actions", "rewards", "terminals"]
+
+    def __init__(self, capacity, directory, resume=True):
+        super().__init__(capacity)
+        self.directory = directory
+        header = self._read_header() if resume else None
+        if header is not None and header["capacity"] == capacity:
+            self._open(header)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _read_header(self):
+        try:
+            with open(self._path("header.json")) as header:
+                return json.load(header)
+        except (OSError, ValueError):
+            return None
+
+    def _open(self, header):
+        for name in self.arrays:
+            setattr(self, name, np.lib.format.open_memmap(self._path(name + ".npy"), mode="r+"))
+        self._size = header["size"]
+        self._next = header["next"]
+
+    def _allocate(self, state):
+        os.makedirs(self.directory, exist_ok=True)
+        shapes = {"states": ((self.capacity,) + state.shape, state.dtype),
+                  "next_states": ((self.capacity,) + state.shape, state.dtype),
+                  "actions": ((self.capacity,), self.actions.dtype),
+                  "rewards": ((self.capacity,), self.rewards.dtype),
+                  "terminals": ((self.capacity,), self.terminals.dtype)}
+        for name in self.arrays:
+            shape, dtype = shapes[name]
+            setattr(self, name, np.lib.format.open_memmap(self._path(name + ".npy"), mode="w+",
+                                                          dtype=dtype, shape=shape))
+        self.flush()
+
+    def flush(self):
+        """write the arrays and the header to disk"""
+        if self.states is None:
+            return
+        for name in self.arrays:
+            getattr(self, name).flush()
+        header_path = self._path("header.json")
+        with open(header_path + ".tmp", "w") as header:
+            json.dump({"capacity": self.capacity, "size": self._size, "next": self._next}, header)
+        # the header is replaced at once, a crash leaves the previous one
+        os.replace(header_path + ".tmp", header_path)
+
+
+class SumTree:
+    """A binary tree whose leaves are the priorities of the slots of a replay store and whose
+    nodes are the sums of their children, to pick slots with probability proportional to
+    their priority in O(log n). Both updates and searches work on arrays of slots at once"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.leaves = 1
+        while self.leaves < capacity:
+            self.leaves *= 2
+        # node 1 is the root, the children of node i are 2i and 2i + 1, leaf k is node leaves + k
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, slots):
+        return self.tree[self.leaves + np.asarray(slots)]
+
+    def update(self, slots, priorities):
+        """set the priorities of the given slots (if a slot is repeated its last priority is kept)"""
+        nodes = self.leaves + np.asarray(slots, dtype=np.int64)
+        self.tree[nodes] = priorities
+        # the nodes are all on the same level, up to the root
+        while len(nodes) and nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """return the slots in which the given cumulative priorities (from 0 to total) fall"""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(len(values), dtype=np.int64)
+        while nodes[0] < self.leaves:
+            nodes *= 2
+            left = self.tree[nodes]
+            # rounding errors must not lead to an empty subtree
+            right = (values > left) & (self.tree[nodes + 1] > 0)
+            values[right] -= left[right]
+            nodes[right] += 1
+        return nodes - self.leaves
+
+
+class IndexSet:
+    """A set of slots of a replay store, with O(1) add, discard and pick of a random member"""
+
+    def __init__(self, capacity):
+        self.members = np.zeros(capacity, dtype=np.int64)
+        # the position of each slot in members, -1 if it is not in the set
+        self.positions = np.full(capacity, -1, dtype=np.int64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, slot):
+        if self.positions[slot] < 0:
+            self.members[self.size] = slot
+            self.positions[slot] = self.size
+            self.size += 1
+
+    def discard(self, slot):
+        position = self.positions[slot]
+        if position >= 0:
+            # the last member takes the place of the discarded one
+            last = self.members[self.size - 1]
+            self.members[position] = last
+            self.positions[last] = position
+            self.positions[slot] = -1
+            self.size -= 1
+
+    def sample(self, n):
+        """return n random members (with repetitions)"""
+        return self.members[np.random.randint(self.size, size=n)]
+
+
+# the replay stores, by history_storage option
+replay_stores = {"ring": RingReplay, "dedup": DedupReplay, "memmap": MemmapReplay}
+
+
+def make_replay_store(configs):
+    """return the replay store chosen by configs["history_storage"], of configs["histsize"] transitions"""
+    storage = configs["history_storage"]
+    if storage == "memmap":
+        return MemmapReplay(configs["histsize"], configs["history_dir"], resume=configs["save_history"])
+    if storage == "dedup":
+        return DedupReplay(configs["histsize"], lookback=configs["n_step"])
+    return replay_stores[storage](configs["histsize"])
@@ -15,7 +15,6 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import itertools
 from abc import ABC, abstractmethod
 
 #class naming:
@@ -39,36 +38,44 @@ class RewardGenerator(ABC):
         self.rb = rogue_box
         self.objective_achieved = False
 
+    def reset(self):
+        """Forget the infos about the previous game, called when the game restarts."""
+        self.objective_achieved = False
+
     @abstractmethod
     def compute_reward(self, old_screen, new_screen):
         pass
 
+    def reward(self, old_screen, new_screen):
+        """return the reward of compute_reward(), 0 while the status bar of either screen
+        is still being drawn: the fields it misses (None) cannot be compared"""
+        for screen in (old_screen, new_screen):
+            statusbar = self.rb.get_statusbar(screen)
+            if statusbar is not None and None in statusbar:
+                return 0
+        return self.compute_reward(old_screen, new_screen)
+
     def get_infos(self, old_screen, new_screen):
         # parse the screen for infos
         # infos is in the format {"info_name": {"old": old_value, "new": new_value}}
+        # the status bars must be complete, see reward()
         infos = {"screen": {"old": old_screen, "new": new_screen}}
 
         for state in ["old", "new"]:
             # parse status bar
             # status bar is the last line
-            statusbar = infos["screen"][state][-1]
-            parsed_statusbar = self.rb.parse_statusbar_re.match(statusbar)
-            statusbar_infos = parsed_statusbar.groupdict()
+            statusbar_infos = self.rb.get_statusbar(infos["screen"][state])._asdict()
             for info in statusbar_infos:
                 if not infos.get(info):
                     infos[info] = {}
-                infos[info][state] = int(statusbar_infos[info])
+                infos[info][state] = statusbar_infos[info]
             
         # count visible map pixels
         # do this only if we are on the same floor
         if infos["dungeon_level"]["new"] == infos["dungeon_level"]["old"]:
             for state in ["old", "new"]:
-                count = 0
                 # do not include message and status bars
-                for line in infos["screen"][state][1:-1]:
-                    for pixel in line:
-                        if pixel != ' ':
-                            count += 1
+                count = self.rb.get_glyph_index(infos["screen"][state]).non_blank
                 if not infos.get("explored_tiles"):
                     infos["explored_tiles"] = {}
                 infos["explored_tiles"][state] = count
@@ -78,10 +85,7 @@ class RewardGenerator(ABC):
         return infos
 
     def get_player_pos(self, screen):
-      for i, j in itertools.product(range(1, 23), range(80)):
-        pixel = screen[i][j]
-        if pixel == "@":
-          return (i, j)
+        return self.rb.get_glyph_index(screen).first_player_pos
 
     def manhattan_distance(self, a, b):
         return abs(a[0] - b[0]) + abs(a[1] - b[1])
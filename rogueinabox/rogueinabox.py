@@ -19,19 +19,47 @@ import time
 import os
 import fcntl
 import pty
+import select
 import signal
 import shlex
 import pyte
 import re
+import threading
+import queue
+from collections import namedtuple
 import numpy as np
-import itertools
 import scipy
 
 import rewards
 import states
+from profiler import StepProfiler, NullProfiler
+from glyphindex import GlyphIndex
+from rogueterm import RogueTerminal
+
+# the values shown in rogue's status bar, in order (None if a field is not drawn yet)
+StatusBar = namedtuple("StatusBar", ["dungeon_level", "gold", "current_hp", "max_hp", "current_strength",
+                                     "max_strength", "armor", "exp_level", "tot_exp"])
+
+
+def _level_increased(old_statusbar, new_statusbar):
+    """check if the dungeon level of new_statusbar is higher, False if either is not drawn"""
+    if old_statusbar.dungeon_level is None or new_statusbar.dungeon_level is None:
+        return False
+    return new_statusbar.dungeon_level > old_statusbar.dungeon_level
+
+
+def screen_to_array(screen):
+    """return the given screen (list of strings) as a numpy array of uint8 character codes,
+    with a row for each line. Characters that do not fit in a byte are mapped to 0"""
+    codes = np.frombuffer("".join(screen).encode("utf-32-le"), dtype=np.uint32)
+    codes = np.where(codes < 256, codes, 0).astype(np.uint8)
+    return codes.reshape(len(screen), -1)
+
 
 class Terminal:
     def __init__(self, columns, lines):
+        self.columns = columns
+        self.lines = lines
         self.screen = pyte.DiffScreen(columns, lines)
         self.stream = pyte.ByteStream()
         self.stream.attach(self.screen)
@@ -39,11 +67,45 @@ class Terminal:
     def feed(self, data):
         self.stream.feed(data)
 
+    def reset(self):
+        """clear the screen and forget any partially parsed output"""
+        self.screen.reset()
+        self.stream = pyte.ByteStream()
+        self.stream.attach(self.screen)
+
     def read(self):
+        self.screen.dirty.clear()
         return self.screen.display
 
+    def read_dirty(self):
+        """return the lines changed since the last read as a dict {row: line}"""
+        dirty = {y: self._render_line(y) for y in self.screen.dirty if y < self.lines}
+        self.screen.dirty.clear()
+        return dirty
+
+    def read_array(self, rows, lines):
+        """return the given rows (whose text is 'lines') as an array of character codes"""
+        return screen_to_array(lines)
+
+    def _render_line(self, y):
+        line = self.screen.buffer[y]
+        return "".join(line[x].data for x in range(self.columns))
+
+
+# terminal backends, selected by the "terminal" config
+terminals = {
+    "pyte": Terminal,
+    "rogue": RogueTerminal,
+}
+
+
+def open_terminal(command="bash", columns=80, lines=24, terminal_class=Terminal):
+    p_pid, p_out = spawn(command, columns, lines)
+    return terminal_class(columns, lines), p_pid, p_out
+
 
-def open_terminal(command="bash", columns=80, lines=24):
+def spawn(command="bash", columns=80, lines=24):
+    """run 'command' in a new pty, return its pid and the pty master as a file-like object"""
     p_pid, master_fd = pty.fork()
     if p_pid == 0:  # Child.
         path, *args = shlex.split(command)
@@ -61,7 +123,138 @@ def open_terminal(command="bash", columns=80, lines=24):
     fcntl.fcntl(master_fd, fcntl.F_SETFL, flag | os.O_NONBLOCK)
     # File-like object for I/O with the child process aka command.
     p_out = os.fdopen(master_fd, "w+b", 0)
-    return Terminal(columns, lines), p_pid, p_out
+    return p_pid, p_out
+
+
+def wait_for_statusbar(terminal, pipe, parse_statusbar_re, timeout, settle_timeout):
+    """feed rogue's output to 'terminal' until the status bar shows up (meaning that rogue
+    is waiting for a command on the map screen), then until the output settles.
+    Return True if the status bar was found within 'timeout' seconds"""
+    poller = select.poll()
+    poller.register(pipe, select.POLLIN)
+    deadline = time.perf_counter() + timeout
+    found = False
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return found
+        if not poller.poll((min(settle_timeout, remaining) if found else remaining) * 1000):
+            if found:
+                return True
+            continue
+        try:
+            update = pipe.read(65536)
+        except OSError:
+            # the pty raises EIO when rogue has exited
+            return False
+        if update:
+            terminal.feed(update)
+            found = found or bool(parse_statusbar_re.match(terminal.read()[-1]))
+
+
+class RoguePoolError(Exception):
+    """The rogue pool could not start rogue."""
+
+
+class RogueStartError(Exception):
+    """Rogue did not get to the map screen."""
+
+
+class RoguePool:
+    """Keep 'size' rogue processes started in background, each waiting at its first map screen.
+    A thread refills the pool whenever a process is taken.
+    When rogue fails to start the thread waits before retrying, twice as long after each failure
+    in a row; after max_failures failures in a row it stops and get() raises a RoguePoolError"""
+
+    def __init__(self, command, size, parse_statusbar_re, timeout, settle_timeout, terminal_class=Terminal,
+                 max_failures=5, retry_delay=0.5):
+        self.command = command
+        self.terminal_class = terminal_class
+        self.size = size
+        self.parse_statusbar_re = parse_statusbar_re
+        self.timeout = timeout
+        self.settle_timeout = settle_timeout
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        # the reason the pool stopped, None while it is running
+        self.error = None
+        self._ready = queue.Queue()
+        self._refill = threading.Event()
+        self._stop = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _start_rogue(self):
+        """start a rogue process, return its (terminal, pid, pipe) if it reached the map screen, else None"""
+        try:
+            terminal, pid, pipe = open_terminal(command=self.command, terminal_class=self.terminal_class)
+        except OSError:
+            return None
+        if wait_for_statusbar(terminal, pipe, self.parse_statusbar_re, self.timeout, self.settle_timeout):
+            return terminal, pid, pipe
+        self._kill(pid, pipe)
+        return None
+
+    def _run(self):
+        failures = 0
+        while not self._closed:
+            if self._ready.qsize() < self.size:
+                started_rogue = self._start_rogue()
+                if started_rogue is None:
+                    failures += 1
+                    if failures >= self.max_failures:
+                        self.error = RoguePoolError("Could not start '{}' after {} attempts.".format(
+                            self.command, failures))
+                        return
+                    self._stop.wait(self.retry_delay * 2 ** (failures - 1))
+                    continue
+                failures = 0
+                if self._closed:
+                    self._kill(*started_rogue[1:])
+                else:
+                    self._ready.put(started_rogue)
+            else:
+                self._refill.wait()
+                self._refill.clear()
+
+    def get(self):
+        """return a (terminal, pid, pipe) tuple of a ready rogue process,
+        None if the pool is empty. Raise a RoguePoolError if the pool stopped because rogue does not start"""
+        while True:
+            try:
+                terminal, pid, pipe = self._ready.get_nowait()
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+                return None
+            finally:
+                self._refill.set()
+            if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                return terminal, pid, pipe
+            # the process died while waiting
+            self._kill(pid, pipe)
+
+    @staticmethod
+    def _kill(pid, pipe):
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+        pipe.close()
+
+    def close(self):
+        """stop refilling the pool and kill the waiting processes"""
+        self._closed = True
+        self._refill.set()
+        self._stop.set()
+        while True:
+            try:
+                terminal, pid, pipe = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            self._kill(pid, pipe)
 
 
 class RogueBox:
@@ -72,25 +265,65 @@ class RogueBox:
         """start rogue and get initial screen"""
         self.configs = configs
         self.rogue_path = self.configs["rogue"]
-        self.terminal, self.pid, self.pipe = open_terminal(command=self.rogue_path)
+        # upper bound on how long we wait for rogue to answer a command, and how long
+        # its output must stay quiet before we consider the screen settled (in seconds)
+        self.refresh_timeout = self.configs["refresh_timeout"]
+        self.settle_timeout = self.configs["settle_timeout"]
+        # per stage timing of send_command(), see get_step_profile()
+        self.profiler = StepProfiler() if self.configs["profile_steps"] else NullProfiler()
+        self.parse_statusbar_re = self._compile_statusbar_re()
+        self.terminal_class = terminals[self.configs["terminal"]]
+        # rogue processes started in background, used to make reset() fast
+        self.rogue_pool = None
+        if self.configs["rogue_pool_size"] > 0:
+            self.rogue_pool = RoguePool(self.rogue_path, self.configs["rogue_pool_size"], self.parse_statusbar_re,
+                                        self.configs["startup_timeout"], self.settle_timeout, self.terminal_class)
+        self.terminal = None
+        # GlyphIndex of the last screens, {tuple(screen): index}
+        self._glyph_indexes = {}
+        # parsed status bar of the last screens, {status bar line: StatusBar or None}
+        self._statusbars = {}
+        self._start_game()
+        self.reward_generator = getattr(rewards, self.configs["reward_generator"])(self)
+        self.state_generator = getattr(states, self.configs["state_generator"])(self)
+
+    def _start(self):
+        """start a new game, taking the rogue process from the pool if one is ready.
+        Return False if rogue did not show the map screen within startup_timeout seconds"""
+        started_rogue = self.rogue_pool.get() if self.rogue_pool else None
+        if started_rogue:
+            # the pool already fed the first screen to its terminal
+            self.terminal, self.pid, self.pipe = started_rogue
+            ready = True
+        else:
+            if self.terminal is None:
+                self.terminal = self.terminal_class(80, 24)
+            else:
+                self.terminal.reset()
+            self.pid, self.pipe = spawn(command=self.rogue_path)
+            ready = wait_for_statusbar(self.terminal, self.pipe, self.parse_statusbar_re,
+                                       self.configs["startup_timeout"], self.settle_timeout)
+            if not ready:
+                # if rogue could not start, give its process the time to exit
+                deadline = time.perf_counter() + self.refresh_timeout
+                while self.is_running() and time.perf_counter() < deadline:
+                    time.sleep(0.01)
+                if not self.is_running():
+                    print("Could not find the executable in %s." % self.rogue_path)
+                    exit()
+        self.poller = select.poll()
+        self.poller.register(self.pipe, select.POLLIN)
         # our internal screen is list of lines, each line is a string
         # can be indexed as a 24x80 matrix
-        self.screen = []
+        self._read_terminal()
         self.stairs_pos = None
         self.player_pos = None
         self.past_positions = []
-        time.sleep(0.5)
-        if not self.is_running():
-            print("Could not find the executable in %s." % self.rogue_path)
-            exit()
-        self._update_screen()
         try:
             self._update_player_pos()
         except:
             pass
-        self.parse_statusbar_re = self._compile_statusbar_re()
-        self.reward_generator = getattr(rewards, self.configs["reward_generator"])(self)
-        self.state_generator = getattr(states, self.configs["state_generator"])(self)
+        return ready
 
     @staticmethod
     def _compile_statusbar_re():
@@ -103,13 +336,70 @@ class RogueBox:
                 Exp:\s*(?P<exp_level>\d*)/(?P<tot_exp>\d*)""", re.VERBOSE)
         return parse_statusbar_re
 
+    def _read_pipe(self):
+        """read everything rogue wrote so far, return b"" if nothing is available
+        or the process exited"""
+        try:
+            update = self.pipe.read(65536)
+        except OSError:
+            # the pty raises EIO when rogue has exited
+            update = None
+        return update or b""
+
+    def _wait_for_update(self):
+        """wait for rogue's output and return it once it has settled.
+        Block until rogue starts answering (at most refresh_timeout seconds), then keep
+        reading until no new output arrives for settle_timeout seconds"""
+        updates = []
+        deadline = time.perf_counter() + self.refresh_timeout
+        timeout = self.refresh_timeout
+        while self.poller.poll(timeout * 1000):
+            self.profiler.mark("wait")
+            update = self._read_pipe()
+            self.profiler.mark("read")
+            if not update:
+                break
+            updates.append(update)
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            timeout = min(self.settle_timeout, remaining)
+        # the last (unsuccessful) poll is spent waiting too
+        self.profiler.mark("wait")
+        return b"".join(updates)
+
     def _update_screen(self):
         """update the virtual screen and the class variable"""
-        update = self.pipe.read(65536)
+        self._apply_update(self._wait_for_update())
+
+    def _apply_update(self, update):
+        """feed rogue's output to the virtual terminal and refresh the screen"""
         if update:
             self.terminal.feed(update)
-            self.screen = self.terminal.read()
-
+            if len(self.screen) != self.terminal.lines:
+                self._read_terminal()
+            else:
+                # only refresh the rows the terminal reports as changed.
+                # self.screen and self.screen_array are replaced, not modified in place,
+                # because callers may still hold the previous screen
+                dirty = self.terminal.read_dirty()
+                # a full redraw (e.g. after ^R) marks every row dirty, keep only real changes
+                dirty = {y: line for y, line in dirty.items() if line != self.screen[y]}
+                if dirty:
+                    rows = sorted(dirty)
+                    lines = [dirty[y] for y in rows]
+                    self.screen = self.screen[:]
+                    for y, line in zip(rows, lines):
+                        self.screen[y] = line
+                    self.screen_array = self.screen_array.copy()
+                    self.screen_array[rows] = self.terminal.read_array(rows, lines)
+        self.profiler.mark("feed")
+
+
+    def _read_terminal(self):
+        """read the whole virtual screen"""
+        self.screen = self.terminal.read()
+        self.screen_array = screen_to_array(self.screen)
 
     # get info methods
 
@@ -119,6 +409,10 @@ class RogueBox:
         #actions = ['h', 'j', 'k', 'l']
         return actions
 
+    def get_state_shape(self):
+        """return the shape of the states"""
+        return self.state_generator.shape
+
     def get_legal_actions(self):
         actions = []
         row = self.player_pos[0]
@@ -144,20 +438,71 @@ class RogueBox:
         can be treated like a 24x80 matrix of characters (screen[17][42])"""
         return self.screen
 
+    def get_screen_array(self):
+        """return the screen as a 24x80 numpy array of uint8 character codes"""
+        return self.screen_array
+
+    def get_step_profile(self, reset=False):
+        """return the time spent in each stage of send_command(), see StepProfiler.get_profile().
+        Empty unless the profile_steps option is set. If 'reset' the timings are cleared"""
+        profile = self.profiler.get_profile()
+        if reset:
+            self.profiler.reset()
+        return profile
+
+    def get_glyph_index(self, screen=None):
+        """return the GlyphIndex of 'screen' (the current screen by default).
+        The index of the last few screens is kept, so the old and new screen of a step
+        are scanned once no matter how many generators look at them"""
+        if screen is None:
+            screen = self.screen
+        key = tuple(screen)
+        index = self._glyph_indexes.get(key)
+        if index is None:
+            screen_array = self.screen_array if screen is self.screen else screen_to_array(screen)
+            index = GlyphIndex(screen, screen_array)
+            if len(self._glyph_indexes) >= 4:
+                # forget the oldest screen
+                del self._glyph_indexes[next(iter(self._glyph_indexes))]
+            self._glyph_indexes[key] = index
+        return index
+
+    def get_statusbar(self, screen=None):
+        """return the status bar of 'screen' (the current screen by default) as a StatusBar of ints,
+        None if the screen has no status bar. The fields of a status bar still being drawn may be None.
+        The status bar of the last few screens is kept, so each one is parsed once"""
+        if screen is None:
+            screen = self.screen
+        line = screen[-1]
+        try:
+            return self._statusbars[line]
+        except KeyError:
+            pass
+        statusbar = None
+        parsed_statusbar = self.parse_statusbar_re.match(line)
+        if parsed_statusbar:
+            # a status bar that is still being drawn may have empty fields
+            statusbar = StatusBar(*[int(value) if value else None for value in parsed_statusbar.groups()])
+        if len(self._statusbars) >= 8:
+            # forget the oldest status bar
+            del self._statusbars[next(iter(self._statusbars))]
+        self._statusbars[line] = statusbar
+        return statusbar
+
     def get_stat(self, stat):
-        """Get the chosen 'stat' from the current screen as a string. Available stats:
+        """Get the chosen 'stat' from the current screen as an int. Available stats:
         dungeon_level, gold, current_hp, max_hp, 
         current_strength, max_strength, armor, exp_level, tot_exp """
         return self._get_stat_from_screen(stat, self.screen)
 
     def _get_stat_from_screen(self, stat, screen):
-        """Get the chosen 'stat' from the given 'screen' as a string. Available stats:
-        dungeon_level, gold, current_hp, max_hp, 
+        """Get the chosen 'stat' from the given 'screen' as an int, None if there is no status bar.
+        Available stats: dungeon_level, gold, current_hp, max_hp,
         current_strength, max_strength, armor, exp_level, tot_exp """
-        parsed_status_bar = self.parse_statusbar_re.match(screen[-1])
+        statusbar = self.get_statusbar(screen)
         answer = None
-        if parsed_status_bar:
-            answer = parsed_status_bar.groupdict()[stat]
+        if statusbar:
+            answer = getattr(statusbar, stat)
         return answer
 
     def get_screen_string(self):
@@ -171,20 +516,12 @@ class RogueBox:
     def game_over(self):
         """check if we are at the game over screen (tombstone)"""
         # look for tombstone
-        for line in self.screen:
-            if '_______)' in line or 'You quit' in line:
-                return True
-        return False
+        return self.get_glyph_index().tombstone
 
     def is_map_view(self, screen):
         """return True if the current screen is the dungeon map, False otherwise"""
-        statusbar = screen[-1]
-        parsed_statusbar = self.parse_statusbar_re.match(statusbar)
-        if parsed_statusbar:
-            # if there is a status bar
-            return True
-        else:
-            return False
+        # if there is a status bar
+        return self.get_statusbar(screen) is not None
 
     def is_running(self):
         """check if the rogue process exited"""
@@ -205,32 +542,49 @@ class RogueBox:
     def compute_reward(self, old_screen, new_screen):
         """return the reward for a state transition
         using the function specified during init"""
-        return self.reward_generator.compute_reward(old_screen, new_screen)
+        return self.reward_generator.reward(old_screen, new_screen)
 
 
     # interact with rogue methods
         
     def send_command(self, command):
         """send a command to rogue"""
+        self.profiler.start_step()
         old_screen = self.screen[:]
+        self._write_command(command)
+        self.profiler.mark("write")
+        self._update_screen()
+        result = self._complete_command(old_screen)
+        self.profiler.end_step()
+        return result
+
+    def _write_command(self, command):
+        """write a command on rogue's input, without waiting for the answer"""
         self.pipe.write(command.encode())
         if command in self.get_actions():
             self.pipe.write('\x12'.encode())
-        time.sleep(0.01)
-        self._update_screen()
+
+    def _complete_command(self, old_screen):
+        """process the screen reached after a command sent from 'old_screen',
+        return the same (reward, new_state, terminal) tuple of send_command()"""
         if self._need_to_dismiss():
             # will dismiss all upcoming messages,
             # because dismiss_message() calls send_command() again
             self._dismiss_message()
+        self.profiler.mark("dismiss")
         new_screen = self.screen[:]
         self._update_stairs_pos(old_screen, new_screen)
         self._update_player_pos()
         self._update_past_positions(old_screen, new_screen)
+        self.profiler.mark("positions")
         reward = self.compute_reward(old_screen, new_screen)
+        self.profiler.mark("reward")
         new_state = self.compute_state()
+        self.profiler.mark("state")
         terminal = self.game_over()
         if self.reward_generator.objective_achieved or self.state_generator.need_reset:
             terminal = True
+        self.profiler.mark("terminal")
         return reward, new_state, terminal
 
 
@@ -255,42 +609,26 @@ class RogueBox:
             return False
 
     def _update_stairs_pos(self, old_screen, new_screen):
-        old_statusbar = old_screen[-1]
-        new_statusbar = new_screen[-1]
-        parsed_old_statusbar = self.parse_statusbar_re.match(old_statusbar)
-        parsed_new_statusbar = self.parse_statusbar_re.match(new_statusbar)
-        if parsed_old_statusbar and parsed_new_statusbar:
-            old_statusbar_infos = parsed_old_statusbar.groupdict()
-            new_statusbar_infos = parsed_new_statusbar.groupdict()
-            if new_statusbar_infos["dungeon_level"] > old_statusbar_infos["dungeon_level"]:
+        old_statusbar = self.get_statusbar(old_screen)
+        new_statusbar = self.get_statusbar(new_screen)
+        if old_statusbar and new_statusbar:
+            if _level_increased(old_statusbar, new_statusbar):
                 #changed floor, reset stairsposition to unknown
                 self.stairs_pos = None
             # search the screen for visible stairs
-            for i, j in itertools.product(range(1, 23), range(80)):
-                pixel = new_screen[i][j]
-                if pixel == "%":
-                    self.stairs_pos = (i, j)
+            stairs_pos = self.get_glyph_index().stairs_pos
+            if stairs_pos:
+                self.stairs_pos = stairs_pos
 
     def _update_player_pos(self):
-        found = False
-        for i, j in itertools.product(range(1, 23), range(80)):
-            pixel = self.screen[i][j]
-            if pixel == "@":
-                found = True
-                self.player_pos = (i, j)
-        if not found:
-            self.player_pos = None
+        self.player_pos = self.get_glyph_index().player_pos
 
 
     def _update_past_positions(self, old_screen, new_screen):
-        old_statusbar = old_screen[-1]
-        new_statusbar = new_screen[-1]
-        parsed_old_statusbar = self.parse_statusbar_re.match(old_statusbar)
-        parsed_new_statusbar = self.parse_statusbar_re.match(new_statusbar)
-        if parsed_old_statusbar and parsed_new_statusbar:
-            old_statusbar_infos = parsed_old_statusbar.groupdict()
-            new_statusbar_infos = parsed_new_statusbar.groupdict()
-            if int(new_statusbar_infos["dungeon_level"]) > int(old_statusbar_infos["dungeon_level"]):
+        old_statusbar = self.get_statusbar(old_screen)
+        new_statusbar = self.get_statusbar(new_screen)
+        if old_statusbar and new_statusbar:
+            if _level_increased(old_statusbar, new_statusbar):
                 self.past_positions = []
             elif len(self.past_positions) > 10:
                 self.past_positions.pop(0)
@@ -304,17 +642,17 @@ class RogueBox:
 
     def _count_passables_in_screen(self, screen):
         """Count the passable tiles in a given 'screen' (24*80 matrix) and returns it as an int."""
-        passables = 0
-        impassable_pixels =  '|- '
-        for line in screen:
-            for pixel in line:
-                if pixel not in impassable_pixels:
-                    passables += 1
-        return passables
+        return self.get_glyph_index(screen).count_passables()
 
 
-    def reset(self):
-        """kill and restart the rogue process"""
+    def close(self):
+        """kill the rogue process and the ones waiting in the pool"""
+        self._stop_rogue()
+        if self.rogue_pool:
+            self.rogue_pool.close()
+
+    def _stop_rogue(self):
+        """kill the rogue process"""
         if self.is_running():
             os.kill(self.pid, signal.SIGTERM)
             # wait the process so it doesnt became a zombie
@@ -323,10 +661,23 @@ class RogueBox:
             self.pipe.close()
         except:
             pass
-        try:
-            self.__init__(self.configs)
-        except:
-            self.reset()
+
+    def _start_game(self, attempts=3):
+        """start a new game, trying again if rogue does not get to the map screen.
+        Raise a RogueStartError after 'attempts' failures"""
+        for _ in range(attempts):
+            if self._start():
+                return
+            self._stop_rogue()
+        raise RogueStartError("'{}' did not show the map screen after {} attempts.".format(
+            self.rogue_path, attempts))
+
+    def reset(self):
+        """kill and restart the rogue process"""
+        self._stop_rogue()
+        self._start_game()
+        self.reward_generator.reset()
+        self.state_generator.reset()
 
 
     def quit_the_game(self):
@@ -0,0 +1,402 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import numpy as np
+
+# A minimal terminal emulator for the output of rogue's curses under TERM=linux.
+# It only understands the sequences listed in the linux terminfo entry that
+# curses actually uses to draw (cursor movement, erase, insert/delete, scrolling
+# regions), and it follows pyte's behaviour for each of them so that the two
+# backends produce the same screen, quirks included: pyte keeps the screen as a
+# sparse dict of rows, and deleting lines leaves a row untouched when the row
+# that should move into it was never created, so the rows pyte has created are
+# tracked in 'rows'. Colors and attributes are ignored, the alternate character
+# set is not translated (rogue draws with plain ascii) and non-ascii bytes are
+# dropped. tools/compare_terminals.py checks the two backends on recorded sessions.
+
+_TOKEN_RE = re.compile(rb"""
+      (?P<text>[\x20-\x7e]+)
+    | \x1b\[(?P<private>\??)(?P<params>[0-9;\x20>]*)(?P<csi>[\x40-\x7e])
+    | \x1b\](?:R|P[0-9a-fA-F]{7}|[^\x07\x1b]*(?:\x07|\x1b\\))
+    | \x1b[()*+#%].
+    | \x1b(?P<esc>[^\[\]()*+#%])
+    | (?P<ctrl>[\x00-\x1a\x1c-\xff])
+""", re.VERBOSE | re.DOTALL)
+
+# incomplete escape sequences longer than this are dropped instead of waiting for more output
+_MAX_PENDING = 64
+
+# private modes used by curses
+_DECOM = 6
+_DECAWM = 7
+# ansi modes
+_IRM = 4
+_LNM = 20
+
+
+class RogueTerminal:
+    """Same interface of rogueinabox.Terminal, writing straight into a numpy grid of character codes"""
+
+    def __init__(self, columns, lines):
+        self.columns = columns
+        self.lines = lines
+        # rows have a hidden column past the right margin: in pyte inserting characters pushes
+        # the last one there and deleting characters brings it back
+        self._buffer = bytearray(b" " * ((columns + 1) * lines))
+        self._cells = np.frombuffer(self._buffer, dtype=np.uint8).reshape(lines, columns + 1)
+        # a view of _buffer, it is updated in place
+        self.grid = self._cells[:, :columns]
+        # like pyte, saved cursors survive a reset
+        self.saved_cursors = []
+        self.reset()
+
+    def reset(self):
+        """clear the screen and forget any partially parsed output"""
+        self._cells[:] = ord(" ")
+        self.x = 0
+        self.y = 0
+        self.margins = None
+        self.autowrap = True
+        self.origin_mode = False
+        self.insert_mode = False
+        self.newline_mode = False
+        self.tabstops = set(range(8, self.columns, 8))
+        self.dirty = set(range(self.lines))
+        # the rows in pyte's buffer, the others are blank
+        self.rows = set()
+        self._pending = b""
+
+    # interface
+
+    def feed(self, data):
+        data = self._pending + data
+        self._pending = b""
+        position = 0
+        end = len(data)
+        match = _TOKEN_RE.match
+        while position < end:
+            token = match(data, position)
+            if token is None:
+                # an escape sequence split between two reads, or garbage
+                if end - position < _MAX_PENDING:
+                    self._pending = data[position:]
+                    return
+                position += 1
+                continue
+            position = token.end()
+            kind = token.lastgroup
+            if kind == "text":
+                self._draw(token.group("text"))
+            elif kind == "csi":
+                self._csi(token.group("csi"), token.group("params"), token.group("private"))
+            elif kind == "ctrl":
+                self._control(token.group("ctrl"))
+            elif kind == "esc":
+                self._escape(token.group("esc"))
+            # osc, charset designations and the other two bytes escapes are ignored
+
+    def read(self):
+        self.dirty.clear()
+        self.rows.update(range(self.lines))
+        return [self._render_line(y) for y in range(self.lines)]
+
+    def read_dirty(self):
+        """return the lines changed since the last read as a dict {row: line}"""
+        dirty = {y: self._render_line(y) for y in self.dirty}
+        self.rows.update(self.dirty)
+        self.dirty.clear()
+        return dirty
+
+    def read_array(self, rows, lines):
+        """return the given rows (whose text is 'lines') as an array of character codes"""
+        return self.grid[rows]
+
+    def _render_line(self, y):
+        start = y * (self.columns + 1)
+        return self._buffer[start:start + self.columns].decode("latin-1")
+
+    # drawing
+
+    def _draw(self, text):
+        columns = self.columns
+        while text:
+            if self.x == columns:
+                if self.autowrap:
+                    self.dirty.add(self.y)
+                    self.x = 0
+                    self._index()
+                else:
+                    self.x -= 1
+            if self.insert_mode:
+                self._insert_characters(1)
+                length = 1
+            elif self.autowrap:
+                length = min(len(text), columns - self.x)
+            else:
+                # without autowrap every character past the margin overwrites the last column
+                length = 1
+            start = self.y * (columns + 1) + self.x
+            self._buffer[start:start + length] = text[:length]
+            self.rows.add(self.y)
+            self.x += length
+            text = text[length:]
+        self.dirty.add(self.y)
+
+    def _control(self, char):
+        if char == b"\n" or char == b"\x0b" or char == b"\x0c":
+            self._index()
+            if self.newline_mode:
+                self.x = 0
+        elif char == b"\r":
+            self.x = 0
+        elif char == b"\x08":
+            self._cursor_back(1)
+        elif char == b"\t":
+            self.x = min([stop for stop in self.tabstops if stop > self.x], default=self.columns - 1)
+        # bell, shift in/out and any other byte are ignored
+
+    def _escape(self, char):
+        if char == b"7":
+            self.saved_cursors.append((self.x, self.y, self.origin_mode, self.autowrap))
+        elif char == b"8":
+            if self.saved_cursors:
+                x, y, origin_mode, autowrap = self.saved_cursors.pop()
+                # like pyte, saved modes are restored only when they were set
+                if origin_mode:
+                    self.origin_mode = True
+                if autowrap:
+                    self.autowrap = True
+                # and the cursor is kept inside the scrolling region
+                top, bottom = self.margins or (0, self.lines - 1)
+                self.x = min(max(0, x), self.columns - 1)
+                self.y = min(max(top, y), bottom)
+            else:
+                self.origin_mode = False
+                self._cursor_position(1, 1)
+        elif char == b"D":
+            self._index()
+        elif char == b"E":
+            self._control(b"\n")
+        elif char == b"M":
+            self._reverse_index()
+        elif char == b"H":
+            self.tabstops.add(self.x)
+        elif char == b"c":
+            self.reset()
+
+    def _csi(self, final, params, private):
+        args = [min(int(param or 0), 9999) for param in params.replace(b" ", b"").replace(b">", b"").split(b";")]
+        first = args[0]
+        if final == b"H" or final == b"f":
+            self._cursor_position(first, args[1] if len(args) > 1 else 0)
+        elif final == b"A":
+            top, bottom = self.margins or (0, self.lines - 1)
+            self.y = max(self.y - (first or 1), top)
+        elif final == b"B" or final == b"e":
+            top, bottom = self.margins or (0, self.lines - 1)
+            self.y = min(self.y + (first or 1), bottom)
+        elif final == b"C" or final == b"a":
+            self.x = min(max(0, self.x + (first or 1)), self.columns - 1)
+        elif final == b"D":
+            self._cursor_back(first or 1)
+        elif final == b"E":
+            top, bottom = self.margins or (0, self.lines - 1)
+            self.y = min(self.y + (first or 1), bottom)
+            self.x = 0
+        elif final == b"F":
+            top, bottom = self.margins or (0, self.lines - 1)
+            self.y = max(self.y - (first or 1), top)
+            self.x = 0
+        elif final == b"G" or final == b"`":
+            self.x = min(max(0, (first or 1) - 1), self.columns - 1)
+        elif final == b"d":
+            y = (first or 1) - 1
+            top, bottom = (0, self.lines - 1)
+            if self.origin_mode and self.margins:
+                top, bottom = self.margins
+                y += top
+            self.y = min(max(top, y), bottom)
+        elif final == b"J":
+            self._erase_in_display(first)
+        elif final == b"K":
+            self._erase_in_line(first)
+        elif final == b"X":
+            start = self.y * (self.columns + 1)
+            self._buffer[start + self.x:start + min(self.x + (first or 1), self.columns)] = \
+                b" " * max(0, min(first or 1, self.columns - self.x))
+            self.rows.add(self.y)
+            self.dirty.add(self.y)
+        elif final == b"@":
+            self._insert_characters(first or 1)
+        elif final == b"P":
+            self._delete_characters(first or 1)
+        elif final == b"L":
+            self._insert_lines(first or 1)
+        elif final == b"M":
+            self._delete_lines(first or 1)
+        elif final == b"r":
+            self._set_margins(args[0] if params else None, args[1] if len(args) > 1 else None)
+        elif final == b"h" or final == b"l":
+            self._set_modes(args, private, final == b"h")
+        elif final == b"g":
+            if first == 0:
+                self.tabstops.discard(self.x)
+            elif first == 3:
+                self.tabstops = set()
+        # colors, device reports and everything else are ignored
+
+    # cursor
+
+    def _cursor_position(self, line, column):
+        y = (line or 1) - 1
+        x = (column or 1) - 1
+        if self.origin_mode and self.margins:
+            top, bottom = self.margins
+            y += top
+            if not top <= y <= bottom:
+                return
+        self.x = min(max(0, x), self.columns - 1)
+        self.y = min(max(0, y), self.lines - 1)
+
+    def _cursor_back(self, count):
+        if self.x == self.columns:
+            self.x -= 1
+        self.x = min(max(0, self.x - count), self.columns - 1)
+
+    def _index(self):
+        top, bottom = self.margins or (0, self.lines - 1)
+        if self.y == bottom:
+            self._cells[top:bottom] = self._cells[top + 1:bottom + 1]
+            self._cells[bottom] = ord(" ")
+            self.rows.update(range(top, bottom))
+            self.rows.discard(bottom)
+            self.dirty.update(range(self.lines))
+        else:
+            self.y = min(self.y + 1, bottom)
+
+    def _reverse_index(self):
+        top, bottom = self.margins or (0, self.lines - 1)
+        if self.y == top:
+            self._cells[top + 1:bottom + 1] = self._cells[top:bottom]
+            self._cells[top] = ord(" ")
+            self.rows.update(range(top + 1, bottom + 1))
+            self.rows.discard(top)
+            self.dirty.update(range(self.lines))
+        else:
+            self.y = max(self.y - 1, top)
+
+    # editing
+
+    def _erase_in_display(self, how):
+        if how == 0:
+            rows = range(self.y + 1, self.lines)
+        elif how == 1:
+            rows = range(self.y)
+        else:
+            rows = range(self.lines)
+        # pyte erases every cell it has, the hidden one too
+        self._cells[rows.start:rows.stop] = ord(" ")
+        self.rows.update(rows)
+        self.dirty.update(rows)
+        if how == 0 or how == 1:
+            self._erase_in_line(how)
+
+    def _erase_in_line(self, how):
+        row = self._cells[self.y]
+        if how == 0:
+            row[self.x:self.columns] = ord(" ")
+        elif how == 1:
+            # reaches the hidden cell when the cursor is past the last column
+            row[:self.x + 1] = ord(" ")
+        else:
+            row[:self.columns] = ord(" ")
+        self.rows.add(self.y)
+        self.dirty.add(self.y)
+
+    def _insert_characters(self, count):
+        row = self._cells[self.y]
+        x = self.x
+        row[x + count:] = row[x:self.columns + 1 - count].copy() if x + count <= self.columns else row[x + count:]
+        row[x:x + count] = ord(" ")
+        self.rows.add(self.y)
+        self.dirty.add(self.y)
+
+    def _delete_characters(self, count):
+        row = self._cells[self.y]
+        x = self.x
+        if x + count <= self.columns:
+            row[x:self.columns + 1 - count] = row[x + count:].copy()
+            row[self.columns + 1 - count:] = ord(" ")
+        else:
+            row[x:self.columns] = ord(" ")
+        self.rows.add(self.y)
+        self.dirty.add(self.y)
+
+    def _insert_lines(self, count):
+        top, bottom = self.margins or (0, self.lines - 1)
+        if top <= self.y <= bottom:
+            y = self.y
+            count = min(count, bottom - y + 1)
+            self._cells[y + count:bottom + 1] = self._cells[y:bottom + 1 - count].copy()
+            self._cells[y:y + count] = ord(" ")
+            moved = {row + count for row in self.rows if y <= row <= bottom - count}
+            self.rows.difference_update(range(y, bottom + 1))
+            self.rows.update(moved)
+            self.dirty.update(range(y, self.lines))
+            self.x = 0
+
+    def _delete_lines(self, count):
+        top, bottom = self.margins or (0, self.lines - 1)
+        if top <= self.y <= bottom:
+            # row by row as pyte does: a row whose replacement was never created is left as it is
+            for y in range(self.y, bottom + 1):
+                if y + count <= bottom:
+                    if y + count in self.rows:
+                        self._cells[y] = self._cells[y + count]
+                        self._cells[y + count] = ord(" ")
+                        self.rows.add(y)
+                        self.rows.discard(y + count)
+                else:
+                    self._cells[y] = ord(" ")
+                    self.rows.discard(y)
+            self.dirty.update(range(self.y, self.lines))
+            self.x = 0
+
+    def _set_margins(self, top, bottom):
+        if (top is None or top == 0) and bottom is None:
+            self.margins = None
+            return
+        current_top, current_bottom = self.margins or (0, self.lines - 1)
+        top = current_top if top is None else max(0, min(top - 1, self.lines - 1))
+        bottom = current_bottom if bottom is None else max(0, min(bottom - 1, self.lines - 1))
+        if bottom - top >= 1:
+            self.margins = (top, bottom)
+            self._cursor_position(1, 1)
+
+    def _set_modes(self, modes, private, value):
+        for mode in modes:
+            if private:
+                if mode == _DECAWM:
+                    self.autowrap = value
+                elif mode == _DECOM:
+                    self.origin_mode = value
+                    self._cursor_position(1, 1)
+            elif mode == _IRM:
+                self.insert_mode = value
+            elif mode == _LNM:
+                self.newline_mode = value
@@ -16,7 +16,6 @@
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-import itertools
 from rogueinabox import RogueBox
 
 
@@ -38,13 +37,10 @@ class StalkOMatic(RogueBox):
         return parse_command_re
 
     def _update_player_pos(self):
-        found = False
-        for i, j in itertools.product(range(1, 23), range(80)):
-            pixel = self.screen[i][j]
-            if pixel == "@":
-                found = True
-                self.player_pos = (i, j)
-        if not found:
+        player_pos = self.get_glyph_index().player_pos
+        if player_pos:
+            self.player_pos = player_pos
+        else:
             #sometimes rogomatic doesnt show the player
             #dont know why
             pass
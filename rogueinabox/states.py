@@ -15,9 +15,9 @@
 #You should have received a copy of the GNU General Public License
 #along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import numpy as np
 import scipy
-import itertools
 from abc import ABC, abstractmethod
 
 #class naming:
@@ -30,6 +30,38 @@ from abc import ABC, abstractmethod
 # each layer is separated by an underscore
 # each classname is terminated by _StateGenerator
 # example: M_P_SD_H_StateGenerator
+# any layout following this scheme can be used, its generator is built on first use
+
+# number of buffers each generator cycles through,
+# a state stays valid while the next STATE_POOL_SIZE - 1 states are computed.
+# An agent step computes one state per message dismissed plus one,
+# the agents keep the states of the last two steps
+STATE_POOL_SIZE = 16
+
+
+class StatePool:
+    """A ring of preallocated state buffers, so computing a state allocates no memory.
+    get() hands out the buffers in turn: whoever keeps a state longer than the
+    next few steps (e.g. the history managers) must copy it"""
+
+    def __init__(self, shape, size=STATE_POOL_SIZE):
+        self.shape = tuple(shape)
+        self.buffers = [np.zeros(self.shape, dtype=np.uint8) for _ in range(size)]
+        self._next = 0
+
+    def get(self):
+        """return the next buffer, its content is the one of an old state"""
+        buffer = self.buffers[self._next]
+        self._next = (self._next + 1) % len(self.buffers)
+        # a new view every time, so states computed at different times are never the same object
+        return buffer.view()
+
+    def get_zeros(self):
+        """return the next buffer filled with zeros"""
+        buffer = self.get()
+        buffer.fill(0)
+        return buffer
+
 
 # ABSTRACT CLASSES
 
@@ -39,6 +71,11 @@ class StateGenerator(ABC):
         self.rb = rogue_box
         self._set_shape()
         self.need_reset = False
+        self.pool = StatePool(self._shape)
+
+    def reset(self):
+        """Forget the infos about the previous game, called when the game restarts."""
+        self.need_reset = False
 
     @abstractmethod
     def _set_shape(self):
@@ -50,23 +87,26 @@ class StateGenerator(ABC):
         """Should return the state shape this generator uses, in a form of a tuple."""
         return self._shape
 
+    @classmethod
+    def state_shape(cls):
+        """return the state shape of the generator class, without a rogue box nor a state pool
+        (_set_shape() only looks at the class)"""
+        generator = cls.__new__(cls)
+        generator._set_shape()
+        return generator._shape
+
     @abstractmethod
     def compute_state(self):
         """Should compute the state and return it."""
         pass
 
     def parse_screen(self):
+        index = self.rb.get_glyph_index()
         positions = {}
         positions["stairs_pos"] = [self.rb.stairs_pos]
         positions["player_pos"] = [self.rb.player_pos]
-        positions["passable_pos"] = []
-        positions["doors_pos"] = []
-        for i, j in itertools.product(range(1, 23), range(80)):
-            pixel = self.rb.screen[i][j]
-            if pixel not in '|- ':
-                positions["passable_pos"].append((i, j))
-            if pixel == '+':
-                positions["doors_pos"].append((i, j))
+        positions["passable_pos"] = index.passable_pos
+        positions["doors_pos"] = index.doors_pos
         return positions
     
     def set_layer(self, state, layer, positions, value):
@@ -75,16 +115,30 @@ class StateGenerator(ABC):
                 i, j = pos
                 state[layer][i - 1][j] = value
         return state
+
+    def set_mask_layer(self, state, layer, mask, value):
+        """set to 'value' the cells of 'layer' where 'mask' (a 22x80 boolean array) is True"""
+        state[layer][mask] = value
+        return state
     
+    def on_game_over(self):
+        """Called when the game over screen is reached."""
+        pass
+
     def game_over_state(self, layers):
         # the screen is the tombstone game over screen
         # return an array of 0 to differentiate
-        return np.zeros([layers, 22, 80], dtype=np.uint8)
+        return self._empty_state(layers)
     
     def unknown_state(self, layers):
         # the screen is inventory, option or a transition screen
         # return an array of 1 to differentiate
         # the agents should not get to this case
+        return self._empty_state(layers)
+
+    def _empty_state(self, layers):
+        if self.pool.shape == (layers, 22, 80):
+            return self.pool.get_zeros()
         return np.zeros([layers, 22, 80], dtype=np.uint8)
 
 class H_StateGenerator(StateGenerator):
@@ -93,22 +147,25 @@ class H_StateGenerator(StateGenerator):
         super().__init__(rogue_box)
         self.heatmap = np.zeros((22, 80), dtype=np.uint8)
         self.first_state = True
+        # the floor the heatmap refers to
+        self.heatmap_level = None
+
+    def reset(self):
+        super().reset()
+        self._reset_heatmap()
+
+    def _reset_heatmap(self):
+        self.heatmap.fill(0)
+        self.first_state = True
 
     def find_player(self, screen):
-        player_pos = None
-        for i, j in itertools.product(range(1, 23), range(80)):
-            pixel = screen[i][j]
-            if pixel == '@':
-                player_pos = (i-1, j)
+        player_pos = self.rb.get_glyph_index(screen).player_pos
+        if player_pos:
+            player_pos = (player_pos[0]-1, player_pos[1])
         return player_pos
     
     def find_passable(self, screen):
-        passable_pos = []
-        for i, j in itertools.product(range(1, 23), range(80)):
-            pixel = screen[i][j]
-            if pixel not in '|- ':
-                passable_pos.append((i-1, j))
-        return passable_pos
+        return [(i-1, j) for i, j in self.rb.get_glyph_index(screen).passable_pos]
     
     def find_adjacent(self, player_pos):
         if not player_pos:
@@ -117,50 +174,65 @@ class H_StateGenerator(StateGenerator):
         return adjacent_pos
     
     def find_adjacent_passable(self, screen, player_pos):
-        passable_pos = self.find_passable(screen)
+        passable_mask = self.rb.get_glyph_index(screen).passable_mask
         adjacent_pos = self.find_adjacent(player_pos)
-        return [pos for pos in adjacent_pos if pos in passable_pos]
+        return [pos for pos in adjacent_pos if passable_mask[pos]]
     
     def update_heatmap(self, screen, heatmap):
+        """increase the heat of the player position to the lowest heat around it plus one,
+        return the position updated (None if the player is not on the screen)"""
         player_pos = self.find_player(screen)
         if not player_pos:
-            return heatmap
+            return None
         adjacent_passable = self.find_adjacent_passable(screen, player_pos)
-        update = min([heatmap[i][j] for i, j in adjacent_passable])
-        heatmap[player_pos[0]][player_pos[1]] = update + 1
-        return heatmap
+        update = min([heatmap[pos] for pos in adjacent_passable], default=0)
+        heatmap[player_pos] = update + 1
+        return player_pos
 
     def handle_first_state_heatmap(self):
         player_pos = self.find_player(self.rb.screen)
         if not player_pos:
             pass
         else:
-            self.heatmap[player_pos[0]][player_pos[1]] = 1
+            self.heatmap[player_pos] = 1
         self.first_state = False
 
+    def on_game_over(self):
+        super().on_game_over()
+        self._reset_heatmap()
+
     def set_heatmap_layer(self, state, layer, layers):
+        # a new floor starts with a new heatmap
+        level = self.rb.get_statusbar().dungeon_level
+        if level is not None and level != self.heatmap_level:
+            self._reset_heatmap()
+            self.heatmap_level = level
         if self.first_state:
             self.handle_first_state_heatmap()
         else:
-            self.heatmap = self.update_heatmap(self.rb.screen, self.heatmap)
-        state[layer] = np.copy(self.heatmap)
-        if 3 in state[layer]:
-            self.need_reset = True
-            state = np.zeros([layers, 22, 80], dtype=np.uint8)
-            self.heatmap = np.zeros((22, 80), dtype=np.uint8)
-            self.first_state = True
-        else:
-            state[layer][state[layer] == 1] == 127
-            state[layer][state[layer] == 2] == 255
+            player_pos = self.update_heatmap(self.rb.screen, self.heatmap)
+            # only the player position changed, the heatmap held no 3 before
+            if player_pos and self.heatmap[player_pos] >= 3:
+                self.need_reset = True
+                state[:] = 0
+                self._reset_heatmap()
+                return state
+        state[layer] = self.heatmap
         return state
 
 class Sn_StateGenerator(StateGenerator):
     '''abstract class, needs compute_state to instantiate'''
     def set_snake_layer(self, state, layer):
         unit = 255/10
-        past_positions = self.rb.past_positions
-        for i, pos in enumerate(past_positions):
-            state[layer][pos[0]-1][pos[1]] = (i+1)*unit
+        past_positions = [(i, pos) for i, pos in enumerate(self.rb.past_positions) if pos]
+        if past_positions:
+            rows = [pos[0] - 1 for i, pos in past_positions]
+            columns = [pos[1] for i, pos in past_positions]
+            # the oldest of the 11 past positions wraps around to 24 (280 % 256),
+            # like the uint8 assignment did before numpy 2 made it an error
+            values = [int((i+1)*unit) % 256 for i, pos in past_positions]
+            # on repeated positions the most recent value is kept
+            state[layer][rows, columns] = values
         return state
 
 
@@ -179,6 +251,10 @@ class AsciiToIntStateGenerator(StateGenerator):
     def __init__(self, rogue_box):
         super().__init__(rogue_box)
         self.ascii_to_int_map = self._init_numeric_map()
+        self.ascii_to_int_table = self._init_numeric_table(self.ascii_to_int_map)
+
+    def _set_shape(self):
+        self._shape = (1, 22, 80)
 
     @staticmethod
     def _init_numeric_map():
@@ -194,251 +270,152 @@ class AsciiToIntStateGenerator(StateGenerator):
             count += 1
         return ascii_to_int_map
 
+    @staticmethod
+    def _init_numeric_table(ascii_to_int_map):
+        """return a 256 entries table with the code of each character,
+        the characters missing from ascii_to_int_map get the code after the last one"""
+        unknown = max(ascii_to_int_map.values()) + 1
+        table = np.full(256, unknown, dtype=np.uint8)
+        for char, code in ascii_to_int_map.items():
+            table[ord(char)] = code
+        return table
+
+    def encode(self, screens):
+        """return the numeric representation of the map section of 'screens',
+        an array of character codes of shape (..., 24, 80); the result has shape (..., 22, 80)"""
+        return self.ascii_to_int_table[np.asarray(screens, dtype=np.uint8)[..., 1:23, :]]
+
     def compute_state(self):
-        """return a 22x80 numpy array filled with a numeric state"""
+        """return a 1x22x80 numpy array filled with a numeric state"""
         if self.rb.is_map_view(self.rb.screen):
             # the screen is a map of the dungeon
             # parse it and return a numerical representation
-            state = np.zeros([1, 22, 80], dtype=np.uint8)
-            for i, j in itertools.product(range(1, 23), range(80)):
-                key = self.rb.screen[i][j]
-                state[0][i - 1][j] = self.ascii_to_int_map[key]
+            state = self.pool.get()
+            np.take(self.ascii_to_int_table, self.rb.get_screen_array()[1:23], out=state[0])
         elif self.rb.game_over():
-            self.game_over_state(1)
+            state = self.game_over_state(1)
         else:
-            self.unknown_state(1)
+            state = self.unknown_state(1)
         return state
 
 
-class M_P_S_StateGenerator(StateGenerator):
+class LayeredStateGenerator(StateGenerator):
+    """State generator described by its layers, see layered_state_generator().
+    'layers' is a list with the components of each layer, e.g. [["M"], ["P"], ["D", "S"]]:
+    compute_state() runs the kernel of every component on a buffer of the pool"""
+    layers = []
+
     def __init__(self, rogue_box):
+        # the compiled pipeline, a list of (kernel, layer)
+        self.pipeline = [(LAYER_KERNELS[component], layer)
+                         for layer, components in enumerate(self.layers) for component in components]
         super().__init__(rogue_box)
 
     def _set_shape(self):
-        self._shape = (3, 22, 80)
-
-    def compute_state(self):
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([3, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the stairsposition
-            state = self.set_layer(state, 2, positions["stairs_pos"], 255)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(3)
-        else:
-            state = self.unknown_state(3)
-        return state
-
-
-class M_P_D_StateGenerator(StateGenerator):
-
-    def _set_shape(self):
-        self._shape = (3, 22, 80)
-
-    def compute_state(self):
-        """return a 3x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([3, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(3)
-        else:
-            state = self.unknown_state(3)
-        return state
-
-class M_P_DS_StateGenerator(StateGenerator):
-
-    def _set_shape(self):
-        self._shape = (3, 22, 80)
-
-    def compute_state(self):
-        """return a 3x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([3, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: doors and stairs positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-            state = self.set_layer(state, 2, positions["stairs_pos"], 255)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(3)
-        else:
-            state = self.unknown_state(3)
-        return state
-
-class M_P_D_H_StateGenerator(H_StateGenerator):
-    def _set_shape(self):
-        self._shape = (4, 22, 80)
-
-    def compute_state(self):
-        """return a 4x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([4, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-            
-            # layer 3: heatmap of past positions
-            state = self.set_heatmap_layer(state, 3, 4)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(4)
-            self.heatmap = np.zeros((22, 80), dtype=np.uint8)
-            self.first_state = True
-        else:
-            state = self.unknown_state(4)
-        return state
-    
-class M_P_DS_H_StateGenerator(H_StateGenerator):
-    def _set_shape(self):
-        self._shape = (4, 22, 80)
+        self._shape = (len(self.layers), 22, 80)
 
     def compute_state(self):
-        """return a 4x22x80 numpy array filled with a numeric state"""
+        """return a layersx22x80 numpy array filled with a numeric state"""
+        layers = self._shape[0]
         if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([4, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors and stairs positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-            state = self.set_layer(state, 2, positions["stairs_pos"], 255)
-            
-            # layer 3: heatmap of past positions
-            state = self.set_heatmap_layer(state, 3, 4)
-            
+            state = self.pool.get_zeros()
+            index = self.rb.get_glyph_index()
+            for kernel, layer in self.pipeline:
+                if kernel(self, state, layer, index):
+                    # the kernel asked for a reset, the state stays empty
+                    break
         elif self.rb.game_over():
-            state = self.game_over_state(4)
-            self.heatmap = np.zeros((22, 80), dtype=np.uint8)
-            self.first_state = True
+            state = self.game_over_state(layers)
+            self.on_game_over()
         else:
-            state = self.unknown_state(4)
+            state = self.unknown_state(layers)
         return state
 
-class M_P_D_Sn_StateGenerator(Sn_StateGenerator):
 
-    def _set_shape(self):
-        self._shape = (4, 22, 80)
-
-    def compute_state(self):
-        """return a 3x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([4, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors and stairs positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-
-            # layer 3: snake-like of past positions, with fading
-            state = self.set_snake_layer(state, 3)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(4)
-        else:
-            state = self.unknown_state(4)
-        return state
-
-class M_P_DS_Sn_StateGenerator(Sn_StateGenerator):
-
-    def _set_shape(self):
-        self._shape = (4, 22, 80)
-
-    def compute_state(self):
-        """return a 3x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([4, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors and stairs positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-            state = self.set_layer(state, 2, positions["stairs_pos"], 255)
-
-            # layer 3: snake-like of past positions, with fading
-            state = self.set_snake_layer(state, 3)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(4)
-        else:
-            state = self.unknown_state(4)
-        return state
-
-class M_P_D_S_Sn_StateGenerator(Sn_StateGenerator):
-
-    def _set_shape(self):
-        self._shape = (5, 22, 80)
-
-    def compute_state(self):
-        """return a 3x22x80 numpy array filled with a numeric state"""
-        if self.rb.is_map_view(self.rb.screen):
-            state = np.zeros([5, 22, 80], dtype=np.uint8)
-            positions = self.parse_screen()
-
-            # layer 0: the map
-            state = self.set_layer(state, 0, positions["passable_pos"], 255)
-
-            # layer 1: the player position
-            state = self.set_layer(state, 1, positions["player_pos"], 255)
-
-            # layer 2: the doors positions
-            state = self.set_layer(state, 2, positions["doors_pos"], 255)
-                
-            # layer 3: the stairs positions
-            state = self.set_layer(state, 3, positions["stairs_pos"], 255)
-
-            # layer 4: snake-like of past positions, with fading
-            state = self.set_snake_layer(state, 4)
-
-        elif self.rb.game_over():
-            state = self.game_over_state(5)
+# LAYER KERNELS
+# a kernel writes one component in the given layer of the state,
+# it returns True if the rest of the pipeline must be skipped
+
+def _map_kernel(generator, state, layer, index):
+    generator.set_mask_layer(state, layer, index.passable_mask, 255)
+
+def _player_kernel(generator, state, layer, index):
+    generator.set_layer(state, layer, [generator.rb.player_pos], 255)
+
+def _doors_kernel(generator, state, layer, index):
+    generator.set_mask_layer(state, layer, index.doors_mask, 255)
+
+def _stairs_kernel(generator, state, layer, index):
+    generator.set_layer(state, layer, [generator.rb.stairs_pos], 255)
+
+def _snake_kernel(generator, state, layer, index):
+    generator.set_snake_layer(state, layer)
+
+def _heatmap_kernel(generator, state, layer, index):
+    # stop if this step asks for a reset, even if a previous one did already
+    need_reset = generator.need_reset
+    generator.need_reset = False
+    generator.set_heatmap_layer(state, layer, len(state))
+    asked_reset = generator.need_reset
+    generator.need_reset = need_reset or asked_reset
+    return asked_reset
+
+LAYER_KERNELS = {
+    "M": _map_kernel,
+    "P": _player_kernel,
+    "D": _doors_kernel,
+    "S": _stairs_kernel,
+    "Sn": _snake_kernel,
+    "H": _heatmap_kernel,
+}
+
+# the generators that provide what some components need
+COMPONENT_BASES = {
+    "Sn": Sn_StateGenerator,
+    "H": H_StateGenerator,
+}
+
+_COMPONENT_RE = re.compile("|".join(sorted(LAYER_KERNELS, key=len, reverse=True)))
+
+
+def parse_layers(layout):
+    """split a layout like "M_P_DS_H" in the components of each layer: [["M"], ["P"], ["D", "S"], ["H"]]"""
+    layers = []
+    for layer in layout.split("_"):
+        components = _COMPONENT_RE.findall(layer)
+        if not layer or "".join(components) != layer:
+            raise ValueError("unknown layer '{}' in the state layout '{}'".format(layer, layout))
+        layers.append(components)
+    return layers
+
+
+def layered_state_generator(layout):
+    """return the state generator class for 'layout' (see the class naming at the top)"""
+    layers = parse_layers(layout)
+    components = {component for layer in layers for component in layer}
+    bases = (LayeredStateGenerator,) + tuple(base for component, base in COMPONENT_BASES.items()
+                                             if component in components)
+    return type("{}_StateGenerator".format(layout), bases, {"layers": layers, "__module__": __name__})
+
+
+def __getattr__(name):
+    """build the generators of the layouts that are not defined below on first use"""
+    if name.endswith("_StateGenerator"):
+        try:
+            generator = layered_state_generator(name[:-len("_StateGenerator")])
+        except ValueError:
+            pass
         else:
-            state = self.unknown_state(5)
-        return state
+            globals()[name] = generator
+            return generator
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+M_P_S_StateGenerator = layered_state_generator("M_P_S")
+M_P_D_StateGenerator = layered_state_generator("M_P_D")
+M_P_DS_StateGenerator = layered_state_generator("M_P_DS")
+M_P_D_H_StateGenerator = layered_state_generator("M_P_D_H")
+M_P_DS_H_StateGenerator = layered_state_generator("M_P_DS_H")
+M_P_D_Sn_StateGenerator = layered_state_generator("M_P_D_Sn")
+M_P_DS_Sn_StateGenerator = layered_state_generator("M_P_DS_Sn")
+M_P_D_S_Sn_StateGenerator = layered_state_generator("M_P_D_S_Sn")
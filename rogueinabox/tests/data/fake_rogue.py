@@ -0,0 +1,84 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A tiny curses game that draws screens like rogue's: one room with a door and the stairs,
+the player moving with hjkl, '>' on the stairs goes down a level and 'Q' 'y' shows the
+"You quit" tombstone. Used by the tests to run RogueBoxes without the rogue binary"""
+
+import curses
+import random
+
+STATUSBAR = "Level: {}  Gold: 0      Hp: 12(12)  Str: 16(16)  Arm: 4   Exp: 1/0"
+MOVES = {ord("h"): (0, -1), ord("l"): (0, 1), ord("k"): (-1, 0), ord("j"): (1, 0)}
+
+
+def new_room(rng):
+    """return (top, left, rows, columns) of a random room"""
+    rows, columns = rng.randint(5, 10), rng.randint(10, 40)
+    return rng.randint(2, 22 - rows), rng.randint(1, 79 - columns), rows, columns
+
+
+def main(stdscr):
+    rng = random.Random(0)
+    level = 1
+    top, left, rows, columns = new_room(rng)
+    player = (top + 1, left + 1)
+
+    def draw():
+        stdscr.erase()
+        for i in range(rows):
+            for j in range(columns):
+                if i in (0, rows - 1):
+                    char = "-"
+                elif j in (0, columns - 1):
+                    char = "|"
+                else:
+                    char = "."
+                stdscr.addch(top + i, left + j, char)
+        stdscr.addch(top, left + 3, "+")
+        stdscr.addch(top + rows - 2, left + columns - 2, "%")
+        stdscr.addch(player[0], player[1], "@")
+        stdscr.addstr(23, 0, STATUSBAR.format(level))
+        stdscr.move(*player)
+        stdscr.refresh()
+
+    curses.noecho()
+    curses.cbreak()
+    draw()
+    while True:
+        key = stdscr.getch()
+        if key in MOVES:
+            i, j = player[0] + MOVES[key][0], player[1] + MOVES[key][1]
+            if top < i < top + rows - 1 and left < j < left + columns - 1:
+                player = (i, j)
+        elif key == ord(">") and player == (top + rows - 2, left + columns - 2):
+            level += 1
+            top, left, rows, columns = new_room(rng)
+            player = (top + 1, left + 1)
+        elif key == ord("Q"):
+            stdscr.addstr(0, 0, "really quit?")
+            stdscr.refresh()
+            if stdscr.getch() == ord("y"):
+                stdscr.erase()
+                stdscr.addstr(5, 10, "You quit with 0 gold pieces")
+                stdscr.refresh()
+                stdscr.getch()
+                return
+        draw()
+
+
+curses.wrapper(main)
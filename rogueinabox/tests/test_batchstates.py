@@ -0,0 +1,170 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import numpy as np
+import pytest
+
+import states
+from batchstates import compute_states_batch
+from rogueinabox import RogueBox, screen_to_array
+
+GENERATORS = ["M_P_S_StateGenerator", "M_P_D_StateGenerator", "M_P_DS_StateGenerator", "M_P_D_H_StateGenerator",
+              "M_P_DS_H_StateGenerator", "M_P_D_Sn_StateGenerator", "M_P_DS_Sn_StateGenerator",
+              "M_P_D_S_Sn_StateGenerator", "MH_SnP_D_StateGenerator", "AsciiToIntStateGenerator"]
+STATUSBAR = "Level: {}  Gold: 0      Hp: 12(12)  Str: 16(16)  Arm: 4   Exp: 1/0"
+
+
+class Game:
+    """screens of a made up game: a room per level with a door, a corridor, a monster, an item
+    and the stairs (seen after a few steps), the player walking at random"""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.level = 0
+        self.next_level()
+
+    def next_level(self):
+        self.level += 1
+        rows, columns = self.rng.randint(4, 9), self.rng.randint(8, 30)
+        self.room = (self.rng.randint(2, 21 - rows), self.rng.randint(1, 78 - columns), rows, columns)
+        top, left = self.room[:2]
+        self.player = (top + 1, left + 1)
+        self.steps = 0
+
+    def move(self):
+        top, left, rows, columns = self.room
+        i, j = self.player
+        i, j = self.rng.choice([(i - 1, j), (i + 1, j), (i, j - 1), (i, j + 1), (i, j)])
+        if top < i < top + rows - 1 and left < j < left + columns - 1:
+            self.player = (i, j)
+        self.steps += 1
+
+    def screen(self):
+        top, left, rows, columns = self.room
+        lines = [[" "] * 80 for _ in range(23)]
+        for i in range(rows):
+            for j in range(columns):
+                border = i in (0, rows - 1) or j in (0, columns - 1)
+                lines[top + i][left + j] = ("-" if i in (0, rows - 1) else "|") if border else "."
+        lines[top][left + 2] = "+"
+        lines[top - 1][left + 2] = "#"
+        lines[top + 1][left + columns - 2] = "K"
+        lines[top + rows - 2][left + 1] = "!"
+        if self.steps > 5:
+            lines[top + rows - 2][left + columns - 2] = "%"
+        lines[self.player[0]][self.player[1]] = "@"
+        return ["".join(line) for line in lines] + [STATUSBAR.format(self.level).ljust(80)]
+
+
+def tombstone():
+    screen = [" " * 80 for _ in range(24)]
+    screen[10] = " " * 20 + "_______)" + " " * 52
+    return screen
+
+
+def inventory():
+    screen = [" " * 80 for _ in range(24)]
+    screen[0] = "a) some food".ljust(80)
+    screen[1] = "b) +1 ring mail [4] being worn".ljust(80)
+    screen[2] = "--press space to continue--".ljust(80)
+    return screen
+
+
+def make_roguebox():
+    """a RogueBox without a rogue process, its screen is set by play()"""
+    rb = RogueBox.__new__(RogueBox)
+    rb.parse_statusbar_re = RogueBox._compile_statusbar_re()
+    rb._statusbars = {}
+    rb._glyph_indexes = {}
+    return rb
+
+
+def play(generators, games=6, steps=150, seed=0):
+    """play made up games with every generator computing its states online,
+    return the recorded screens, positions and states"""
+    rng = random.Random(seed)
+    rb = make_roguebox()
+    live = {name: getattr(states, name)(rb) for name in generators}
+    recorded = {"screens": [], "player_pos": [], "stairs_pos": [], "past_positions": [], "new_game": []}
+    states_live = {name: [] for name in generators}
+    for _ in range(games):
+        game = Game(rng)
+        rb.screen = game.screen()
+        rb.player_pos = rb.stairs_pos = None
+        rb.past_positions = []
+        for generator in live.values():
+            generator.reset()
+        for step in range(steps):
+            old_screen = rb.screen
+            if step == 0:
+                screen = old_screen
+            elif step == steps - 1:
+                screen = tombstone()
+            elif rng.random() < 0.05:
+                screen = inventory()
+            else:
+                if rng.random() < 0.03:
+                    game.next_level()
+                else:
+                    game.move()
+                screen = game.screen()
+            rb.screen = screen
+            rb.screen_array = screen_to_array(screen)
+            rb._update_stairs_pos(old_screen, screen)
+            rb._update_player_pos()
+            rb._update_past_positions(old_screen, screen)
+            recorded["screens"].append(rb.screen_array)
+            recorded["player_pos"].append(rb.player_pos)
+            recorded["stairs_pos"].append(rb.stairs_pos)
+            recorded["past_positions"].append(list(rb.past_positions))
+            recorded["new_game"].append(step == 0)
+            for name, generator in live.items():
+                states_live[name].append(generator.compute_state().copy())
+    return recorded, {name: np.stack(states_batch) for name, states_batch in states_live.items()}
+
+
+@pytest.fixture(scope="module")
+def recorded_game():
+    return play(GENERATORS)
+
+
+@pytest.mark.parametrize("name", GENERATORS)
+def test_batch_equals_online_generator(recorded_game, name):
+    recorded, states_live = recorded_game
+    states_batch = compute_states_batch(name, **recorded)
+    assert states_batch.shape == states_live[name].shape
+    assert np.array_equal(states_batch, states_live[name])
+
+
+def test_made_up_game_covers_the_layers(recorded_game):
+    recorded, states_live = recorded_game
+    map_view = np.array([screen[-1].tobytes().startswith(b"Level") for screen in recorded["screens"]])
+    empty = ~states_live["M_P_D_H_StateGenerator"].any(axis=(1, 2, 3))
+    # some states were emptied by a revisited cell, some are the inventory or the tombstone
+    assert (map_view & empty).any() and (~map_view & empty).any()
+    assert (states_live["M_P_D_H_StateGenerator"][:, 3] == 2).any()
+    assert any(pos is not None for pos in recorded["stairs_pos"])
+    assert any(len(positions) == 11 for positions in recorded["past_positions"])
+
+
+@pytest.mark.parametrize("name", ["M_P_DS_H_StateGenerator", "M_P_D_S_Sn_StateGenerator"])
+def test_parallel_batch_equals_serial(recorded_game, name):
+    recorded, states_live = recorded_game
+    # by layout too
+    states_batch = compute_states_batch(name[:-len("_StateGenerator")], processes=2, chunk_size=200, **recorded)
+    assert np.array_equal(states_batch, states_live[name])
@@ -0,0 +1,66 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import random
+import numpy as np
+import pytest
+
+from glyphindex import GlyphIndex, MONSTERS, ITEMS
+from rogueinabox import screen_to_array
+
+MAP_CELLS = list(itertools.product(range(1, 23), range(80)))
+
+
+def random_screen(rng):
+    screen = ["".join(rng.choice(" .|-+%@#ABZ!*$^") for _ in range(80)) for _ in range(24)]
+    if rng.random() < 0.3:
+        screen[10] = screen[10][:20] + "_______)" + screen[10][28:]
+    return screen
+
+
+def cells(screen, chars):
+    """the map positions of the given characters, in reading order"""
+    return [(i, j) for i, j in MAP_CELLS if screen[i][j] in chars]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_index_matches_the_screen(seed):
+    rng = random.Random(seed)
+    screen = random_screen(rng)
+    index = GlyphIndex(screen, screen_to_array(screen))
+    passables = [(i, j) for i, j in MAP_CELLS if screen[i][j] not in "|- "]
+    assert index.passable_pos == passables
+    assert index.doors_pos == cells(screen, "+")
+    players, stairs = cells(screen, "@"), cells(screen, "%")
+    assert index.first_player_pos == players[0] and index.player_pos == players[-1]
+    assert index.stairs_pos == stairs[-1]
+    assert index.non_blank == len(MAP_CELLS) - len(cells(screen, " "))
+    assert index.tombstone == any("_______)" in line for line in screen)
+    assert index.count_passables() == sum(char not in "|- " for line in screen for char in line)
+    for mask, chars in [(index.monsters_mask, MONSTERS), (index.items_mask, ITEMS), (index.doors_mask, "+")]:
+        assert mask.shape == (22, 80)
+        assert [(int(i) + 1, int(j)) for i, j in np.argwhere(mask)] == cells(screen, chars)
+
+
+def test_empty_map():
+    screen = [" " * 80 for _ in range(23)] + ["You quit with 0 gold pieces".ljust(80)]
+    index = GlyphIndex(screen, screen_to_array(screen))
+    assert index.player_pos is None and index.first_player_pos is None and index.stairs_pos is None
+    assert index.passable_pos == [] and index.doors_pos == [] and index.non_blank == 0
+    # the message and status bars are not part of the map
+    assert index.tombstone and index.count_passables() == len("You quit with 0 gold pieces") - 5
@@ -0,0 +1,80 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+import pytest
+
+from historychunks import read_index, save_chunks, load_chunks
+from replay import RingReplay
+
+
+def fill(store, first, last):
+    """add the transitions first...last-1, transition t goes from state t to state t + 1"""
+    for t in range(first, last):
+        store.add(np.full((2, 3, 4), t % 256, np.uint8), t % 5, float(t), np.full((2, 3, 4), (t + 1) % 256, np.uint8),
+                  t % 9 == 0)
+
+
+def rewards_of(store):
+    """the rewards of the stored transitions, the oldest first"""
+    return [transition[2] for transition in store.transitions()][::-1]
+
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_round_trip(tmp_path, compression):
+    store = RingReplay(100)
+    fill(store, 0, 45)
+    save_chunks(store, str(tmp_path), 45, chunk_size=30, compression=compression)
+    assert [chunk["transitions"] for chunk in read_index(str(tmp_path))["chunks"]] == [30, 15]
+    first_chunk = os.path.join(str(tmp_path), read_index(str(tmp_path))["chunks"][0]["file"])
+    with open(first_chunk, "rb") as f:
+        first_chunk_data = f.read()
+
+    fill(store, 45, 130)
+    save_chunks(store, str(tmp_path), 130, chunk_size=30, compression=compression)
+    index = read_index(str(tmp_path))
+    # the short chunk is rewritten, the full one is kept as it is
+    assert [chunk["transitions"] for chunk in index["chunks"]] == [30, 30, 30, 30, 10]
+    assert index["transitions"] == 130 and index["compression"] == compression
+    with open(first_chunk, "rb") as f:
+        assert f.read() == first_chunk_data
+
+    loaded = RingReplay(100)
+    assert load_chunks(loaded.add, str(tmp_path), capacity=loaded.capacity) == 130
+    assert rewards_of(loaded) == list(range(30, 130))
+    for a, b in zip(store.transitions(), loaded.transitions()):
+        assert np.array_equal(a[0], b[0]) and a[1:3] == b[1:3]
+        assert np.array_equal(a[3], b[3]) and a[4] == b[4]
+
+
+def test_dropped_transitions_are_lost(tmp_path):
+    store = RingReplay(50)
+    fill(store, 0, 20)
+    save_chunks(store, str(tmp_path), 20, chunk_size=30)
+    # the store kept only the last 50 of the 100 transitions added since
+    fill(store, 20, 120)
+    save_chunks(store, str(tmp_path), 120, chunk_size=30)
+    loaded = RingReplay(200)
+    assert load_chunks(loaded.add, str(tmp_path)) == 120
+    assert rewards_of(loaded) == list(range(20)) + list(range(70, 120))
+
+
+def test_load_without_index(tmp_path):
+    store = RingReplay(10)
+    assert load_chunks(store.add, str(tmp_path)) == 0
+    assert len(store) == 0
@@ -0,0 +1,108 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import pytest
+
+import profiler
+from profiler import StepProfiler, NullProfiler, format_profile, merge_profiles
+
+
+class Clock:
+    """a perf_counter moved by hand"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(profiler, "perf_counter", clock)
+    return clock
+
+
+def step(step_profiler, clock, durations):
+    """run a step whose stages take the given {stage: seconds}"""
+    step_profiler.start_step()
+    for stage, duration in durations.items():
+        clock.now += duration
+        step_profiler.mark(stage)
+    step_profiler.end_step()
+
+
+def test_stage_timings(clock):
+    step_profiler = StepProfiler(["write", "wait", "read"])
+    step(step_profiler, clock, {"write": 2e-6, "wait": 2e-3, "read": 5e-5})
+    step(step_profiler, clock, {"write": 4e-6, "wait": 0.5, "read": 5e-5})
+    profile = step_profiler.get_profile()
+    assert profile["steps"] == 2
+    assert profile["stages"]["wait"]["total"] == pytest.approx(0.502)
+    assert profile["stages"]["write"]["mean"] == pytest.approx(3e-6)
+    # 2 ms and 500 ms fall in the buckets below 3 ms and in the last one
+    assert profile["stages"]["wait"]["histogram"] == [0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+    assert profile["stages"]["write"]["histogram"][0] == 2
+    assert profile["stages"]["read"]["histogram"][2] == 2
+    step_profiler.reset()
+    assert step_profiler.get_profile()["steps"] == 0
+
+
+def test_nested_steps_count_in_the_outer_one(clock):
+    step_profiler = StepProfiler(["write", "dismiss"])
+    step_profiler.start_step()
+    clock.now += 1e-3
+    step_profiler.mark("write")
+    # a message dismissed in the middle of the step
+    step(step_profiler, clock, {"write": 1.0, "dismiss": 1.0})
+    clock.now += 2e-3
+    step_profiler.mark("dismiss")
+    step_profiler.end_step()
+    profile = step_profiler.get_profile()
+    assert profile["steps"] == 1
+    assert profile["stages"]["write"]["total"] == pytest.approx(1e-3)
+    assert profile["stages"]["dismiss"]["total"] == pytest.approx(2.002)
+
+
+def test_null_profiler_measures_nothing():
+    null_profiler = NullProfiler()
+    null_profiler.start_step()
+    time.sleep(0.001)
+    null_profiler.mark("wait")
+    null_profiler.end_step()
+    profile = null_profiler.get_profile()
+    assert profile["steps"] == 0
+    assert all(stage["total"] == 0 for stage in profile["stages"].values())
+
+
+def test_merge_profiles(clock):
+    profiles = []
+    for wait in (1e-3, 3e-3, 5e-3):
+        step_profiler = StepProfiler(["write", "wait"])
+        step(step_profiler, clock, {"write": 1e-5, "wait": wait})
+        step(step_profiler, clock, {"write": 1e-5, "wait": wait})
+        profiles.append(step_profiler.get_profile())
+    merged = merge_profiles(profiles)
+    assert merged["steps"] == 6
+    assert merged["stages"]["wait"]["mean"] == pytest.approx(3e-3)
+    assert sum(merged["stages"]["wait"]["histogram"]) == 6
+    assert merged["stages"]["write"]["histogram"] == [a + b + c for a, b, c in
+                                                     zip(*(p["stages"]["write"]["histogram"] for p in profiles))]
+    assert format_profile(merged).startswith("step profile over 6 steps, 3.010 ms per step (write: 0.010, wait: 3.000")
+    assert merge_profiles([])["steps"] == 0
@@ -0,0 +1,155 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import numpy as np
+import pytest
+
+from replay import RingReplay, DedupReplay, MemmapReplay, SumTree, IndexSet, make_replay_store
+
+SHAPE = (1, 3, 4)
+
+
+def random_state(rng):
+    return rng.integers(0, 5, SHAPE, dtype=np.uint8)
+
+
+def play(stores, steps=3000, streams=1, n_step=1, keep=1.0, seed=0):
+    """add to every store the same transitions of 'streams' games played in turn, each transition
+    going from the state of a step to the one n_step steps later; only a 'keep' share of them is added.
+    Return the number of transitions added"""
+    rng = np.random.default_rng(seed)
+    choices = random.Random(seed)
+    games = [[random_state(rng)] for _ in range(streams)]
+    added = 0
+    for t in range(steps):
+        stream = t % streams
+        game = games[stream]
+        state = random_state(rng)
+        if choices.random() < 0.01:
+            # the player did not move
+            state = game[-1].copy()
+        game.append(state)
+        terminal = choices.random() < 0.02
+        if len(game) > n_step and choices.random() < keep:
+            for store in stores:
+                store.add(game[-1 - n_step], t % 7, t, state, terminal, stream)
+            added += 1
+        if terminal:
+            games[stream] = [random_state(rng)]
+    return added
+
+
+def assert_same_transitions(store, reference):
+    """check that 'store' holds the newest transitions of 'reference'"""
+    transitions = list(store.transitions())
+    assert len(transitions) > 0
+    for a, b in zip(transitions, reference.transitions()):
+        assert np.array_equal(a[0], b[0]) and a[1:3] == b[1:3]
+        assert np.array_equal(a[3], b[3]) and a[4] == b[4]
+
+
+@pytest.mark.parametrize("streams, n_step, keep", [(1, 1, 1.0), (4, 1, 1.0), (3, 1, 0.3), (2, 3, 1.0)])
+def test_dedup_holds_the_ring_transitions(streams, n_step, keep):
+    ring, dedup = RingReplay(500), DedupReplay(500, reuse_window=32, lookback=n_step)
+    play([ring, dedup], streams=streams, n_step=n_step, keep=keep)
+    assert len(dedup) <= len(ring)
+    assert_same_transitions(dedup, ring)
+    minibatch = dedup.sample(64)
+    assert np.all(minibatch.rewards.astype(int) % 7 == minibatch.actions)
+    for i, index in enumerate(minibatch.indices):
+        assert np.array_equal(minibatch.states[i], dedup.get([index]).states[0])
+
+
+@pytest.mark.parametrize("n_step", [1, 3])
+def test_dedup_stores_each_frame_once(n_step):
+    dedup = DedupReplay(1000, lookback=n_step)
+    added = play([dedup], n_step=n_step)
+    # one frame per transition, plus the first frame of every game
+    assert dedup._frames_stored < 1.1 * added
+
+
+def test_dedup_eviction_invariant():
+    ring, dedup = RingReplay(200), DedupReplay(200, reuse_window=16)
+    evicted = []
+    dedup.on_evict = evicted.append
+    rng = np.random.default_rng(0)
+    added = 0
+    for t in range(2000):
+        # runs of unrelated transitions need two frames each
+        old_state = random_state(rng) if t % 100 < 50 else ring.next_states[(ring._next - 1) % ring.capacity]
+        new_state = random_state(rng)
+        ring.add(old_state, t % 7, t, new_state, False)
+        dedup.add(old_state, t % 7, t, new_state, False)
+        added += 1
+        # the frames of every kept transition were not overwritten
+        kept = dedup.ordered_indices()
+        oldest_frame = dedup._frames_stored - dedup.frames_capacity
+        assert np.all(dedup.old_frames[kept] >= oldest_frame) and np.all(dedup.new_frames[kept] >= oldest_frame)
+        assert len(evicted) == added - len(dedup)
+    assert len(dedup) < dedup.capacity
+    assert_same_transitions(dedup, ring)
+    # the transitions are evicted the oldest first
+    assert evicted == [k % dedup.capacity for k in range(len(evicted))]
+
+
+def test_memmap_resume(tmp_path):
+    configs = {"history_storage": "memmap", "histsize": 100, "history_dir": str(tmp_path), "save_history": True}
+    store = make_replay_store(configs)
+    ring = RingReplay(100)
+    play([store, ring], steps=300)
+    store.flush()
+    resumed = make_replay_store(configs)
+    assert isinstance(resumed.states, np.memmap)
+    assert len(resumed) == len(ring) == 100
+    assert_same_transitions(resumed, ring)
+    # the ring goes on from where it was
+    transition = next(ring.transitions())
+    resumed.add(transition[0], 1, -1.0, transition[3], True)
+    ring.add(transition[0], 1, -1.0, transition[3], True)
+    assert len(resumed) == 100
+    assert_same_transitions(resumed, ring)
+    assert len(make_replay_store(dict(configs, save_history=False))) == 0
+    assert len(MemmapReplay(50, str(tmp_path))) == 0
+
+
+def test_sumtree_sampling_proportions():
+    tree = SumTree(10)
+    priorities = np.array([0.5, 0.0, 3.0, 1.0, 0.25, 2.0, 0.0, 0.1, 4.0, 1.5])
+    # the last priority of a repeated slot is kept
+    tree.update(np.append(np.arange(10), 2), np.append(priorities, 7.0))
+    priorities[2] = 7.0
+    assert tree.total == pytest.approx(priorities.sum())
+    assert np.allclose(tree.get(np.arange(10)), priorities)
+    rng = np.random.default_rng(0)
+    slots = tree.find(rng.uniform(0, tree.total, 200000))
+    frequencies = np.bincount(slots, minlength=tree.leaves) / len(slots)
+    assert np.allclose(frequencies[:10], priorities / priorities.sum(), atol=0.005)
+    assert not frequencies[10:].any() and frequencies[1] == 0 and frequencies[6] == 0
+    # the edges of the range fall in slots with a priority
+    assert tree.find([0.0, tree.total]).tolist() == [0, 9]
+
+
+def test_index_set():
+    members = IndexSet(20)
+    for slot in [3, 7, 3, 11, 19]:
+        members.add(slot)
+    members.discard(7)
+    members.discard(8)
+    assert len(members) == 3
+    assert set(members.members[:len(members)]) == {3, 11, 19}
+    assert set(members.sample(200)) == {3, 11, 19}
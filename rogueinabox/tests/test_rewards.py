@@ -0,0 +1,71 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+import rewards
+from rogueinabox import RogueBox, screen_to_array
+
+STATUSBAR = "Level: 1  Gold: 0      Hp: 12(12)  Str: 16(16)  Arm: 4   Exp: 1/0"
+# curses has not drawn the gold and the strength yet
+PARTIAL_STATUSBAR = "Level: 1  Gold:        Hp: 12(12)  Str: (16)  Arm: 4   Exp: 1/0"
+
+
+def make_screen(player_x, statusbar):
+    screen = [" " * 80 for _ in range(24)]
+    screen[5] = " " * 10 + "-" * 10 + " " * 60
+    screen[6] = " " * 10 + "|" + "." * 8 + "|" + " " * 60
+    screen[6] = screen[6][:player_x] + "@" + screen[6][player_x + 1:]
+    screen[7] = " " * 10 + "-" * 10 + " " * 60
+    screen[23] = statusbar.ljust(80)
+    return screen
+
+
+def make_roguebox(screen):
+    """a RogueBox showing 'screen', without a rogue process"""
+    rb = RogueBox.__new__(RogueBox)
+    rb.parse_statusbar_re = RogueBox._compile_statusbar_re()
+    rb._statusbars = {}
+    rb._glyph_indexes = {}
+    rb.screen = screen
+    rb.screen_array = screen_to_array(screen)
+    rb.past_positions = [(6, 12), (6, 13)]
+    return rb
+
+
+@pytest.mark.parametrize("name", ["SparseRewardGenerator", "A_nW_RewardGenerator", "A_nW_C_RewardGenerator",
+                                  "A_W_RewardGenerator", "E_D_W_RewardGenerator", "E_D_Ps_W_RewardGenerator",
+                                  "E_D_Ps_W_R_RewardGenerator", "E_D_Ps_Pp_W_RewardGenerator"])
+def test_partial_statusbar_gives_no_reward(name):
+    old_screen = make_screen(12, STATUSBAR)
+    for new_screen in (make_screen(13, PARTIAL_STATUSBAR), make_screen(13, STATUSBAR)):
+        for screens in ((old_screen, new_screen), (new_screen, old_screen)):
+            rb = make_roguebox(screens[1])
+            generator = getattr(rewards, name)(rb)
+            reward = generator.reward(*screens)
+            if PARTIAL_STATUSBAR.ljust(80) in screens[0] + screens[1]:
+                assert reward == 0
+                assert rb.get_statusbar(screens[1]) is not None and rb.is_map_view(screens[1])
+            else:
+                assert reward == generator.compute_reward(*screens)
+
+
+def test_partial_statusbar_fields():
+    rb = make_roguebox(make_screen(12, PARTIAL_STATUSBAR))
+    statusbar = rb.get_statusbar()
+    assert statusbar.gold is None and statusbar.current_strength is None
+    assert statusbar.dungeon_level == 1 and statusbar.max_strength == 16
@@ -0,0 +1,84 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+import pytest
+
+from rogueinabox import Terminal
+from rogueterm import RogueTerminal
+import compare_terminals
+
+# a curses session recorded with "compare_terminals.py record"
+SESSION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "rogue_session.bin")
+
+# the sequences curses sends under TERM=linux, plus some it does not
+PIECES = [b"x", b"ab", b"y" * 30, b"z" * 90, b"\n", b"\r", b"\x08", b"\t",
+          b"\x1b7", b"\x1b8", b"\x1bD", b"\x1bM", b"\x1bE", b"\x1bc", b"\x1bH",
+          b"\x1b[H", b"\x1b[5;10H", b"\x1b[30;90H", b"\x1b[2A", b"\x1b[3B", b"\x1b[4C", b"\x1b[2D",
+          b"\x1b[E", b"\x1b[F", b"\x1b[7G", b"\x1b[J", b"\x1b[1J", b"\x1b[2J", b"\x1b[K", b"\x1b[1K",
+          b"\x1b[2K", b"\x1b[3X", b"\x1b[2@", b"\x1b[3P", b"\x1b[2L", b"\x1b[4M", b"\x1b[L", b"\x1b[M",
+          b"\x1b[8;22r", b"\x1b[3;10r", b"\x1b[r", b"\x1b[?6h", b"\x1b[?6l", b"\x1b[?7l", b"\x1b[?7h",
+          b"\x1b[4h", b"\x1b[4l", b"\x1b[20h", b"\x1b[20l", b"\x1b[g", b"\x1b[3g"]
+
+
+def feed_both(chunks):
+    pyte_terminal, rogue_terminal = Terminal(80, 24), RogueTerminal(80, 24)
+    for chunk in chunks:
+        pyte_terminal.feed(chunk)
+        rogue_terminal.feed(chunk)
+    return pyte_terminal, rogue_terminal
+
+
+def test_recorded_session():
+    assert compare_terminals.replay(SESSION)
+
+
+def test_restore_cursor_inside_margins():
+    pyte_terminal, rogue_terminal = feed_both([b"\x1b[8;22r", b"\x1b7", b"\x1b8", b"a"])
+    screen = rogue_terminal.read()
+    assert screen == pyte_terminal.read()
+    assert screen[7].startswith("a")
+
+
+def test_delete_lines_keeps_rows_pyte_never_created():
+    pyte_terminal, rogue_terminal = feed_both([b"x" * 90, b"\x1b[4M"])
+    screen = rogue_terminal.read()
+    assert screen == pyte_terminal.read()
+    assert screen[1].startswith("x" * 10)
+
+
+def test_split_escape_sequence():
+    pyte_terminal, rogue_terminal = feed_both([b"ab\x1b[1", b"0;5Hc\x1b", b"[2Jd"])
+    assert rogue_terminal.read() == pyte_terminal.read()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_streams(seed):
+    rng = random.Random(seed)
+    pyte_terminal, rogue_terminal = Terminal(80, 24), RogueTerminal(80, 24)
+    for _ in range(200):
+        chunk = b"".join(rng.choice(PIECES) for _ in range(rng.randint(1, 6)))
+        pyte_terminal.feed(chunk)
+        rogue_terminal.feed(chunk)
+        # reading creates rows in pyte's buffer, so the reads are part of the stream
+        read = rng.random()
+        if read < 0.2:
+            assert rogue_terminal.read() == pyte_terminal.read()
+        elif read < 0.5:
+            assert rogue_terminal.read_dirty() == pyte_terminal.read_dirty()
+    assert rogue_terminal.read() == pyte_terminal.read()
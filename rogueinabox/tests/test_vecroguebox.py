@@ -0,0 +1,112 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shlex
+import signal
+import sys
+import time
+import numpy as np
+import pytest
+
+import config
+import states
+from rogueinabox import RogueBox
+from vecroguebox import VecRogueBox, SubprocVecRogueBox
+
+# a curses game drawing rogue like screens, so the games run without the rogue binary
+FAKE_ROGUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fake_rogue.py")
+
+
+@pytest.fixture
+def configs():
+    configs = config.ConfigurationManager().get_configs()
+    configs.update({"rogue": "{} {}".format(shlex.quote(sys.executable), shlex.quote(FAKE_ROGUE)),
+                    "state_generator": "M_P_DS_StateGenerator"})
+    return configs
+
+
+def assert_screens_are_current(vrb):
+    for box in vrb.boxes:
+        assert box.screen == box.terminal.read()
+
+
+@pytest.mark.parametrize("name", ["M_P_DS_StateGenerator", "M_P_D_S_Sn_StateGenerator", "AsciiToIntStateGenerator",
+                                  "StringListStateGenerator"])
+def test_state_shape_without_a_game(name):
+    generator_class = getattr(states, name)
+    rb = RogueBox.__new__(RogueBox)
+    assert generator_class.state_shape() == generator_class(rb).shape
+
+
+def test_step_and_restart(configs):
+    vrb = VecRogueBox(configs, 3)
+    epoll = vrb._epoll
+    try:
+        assert vrb.get_state_shape() == (3, 22, 80)
+        assert vrb.compute_states().shape == (3, 3, 22, 80)
+        for commands in ["hjk", "lll", "jjj", "hkj"]:
+            rewards, new_states, terminals = vrb.step(list(commands))
+            assert rewards.shape == (3,) and new_states.shape == (3, 3, 22, 80) and not terminals.any()
+        assert_screens_are_current(vrb)
+        vrb.step(["Q", "Q", "h"])
+        rewards, new_states, terminals = vrb.step(["y", "n", "h"])
+        # the first game ended and started again with a new rogue process
+        assert terminals.tolist() == [True, False, False]
+        assert list(vrb.final_states) == [0] and not vrb.final_states[0].any()
+        assert new_states[0].any() and vrb.boxes[0].is_map_view(vrb.boxes[0].screen)
+        assert vrb._fds == {i: box.pipe.fileno() for i, box in enumerate(vrb.boxes)}
+        assert vrb._epoll is epoll
+        vrb.step(["h", "h", "h"])
+        assert_screens_are_current(vrb)
+    finally:
+        vrb.close()
+    assert epoll.closed
+
+
+def test_rogue_killed(configs):
+    vrb = VecRogueBox(configs, 2)
+    try:
+        os.kill(vrb.boxes[1].pid, signal.SIGKILL)
+        time.sleep(0.2)
+        vrb.step(["h", "h"])
+        # the game whose rogue exited is not listened to, so it does not slow down the steps
+        assert list(vrb._fds) == [0]
+        start = time.perf_counter()
+        vrb.step(["j", "j"])
+        assert time.perf_counter() - start < configs["refresh_timeout"]
+        vrb.reset()
+        assert vrb._fds == {i: box.pipe.fileno() for i, box in enumerate(vrb.boxes)}
+        vrb.step(["k", "k"])
+        assert_screens_are_current(vrb)
+    finally:
+        vrb.close()
+
+
+def test_subproc_vec_roguebox(configs):
+    vrb = SubprocVecRogueBox(configs, 3, 2)
+    try:
+        assert vrb.get_state_shape() == (3, 22, 80)
+        assert vrb.compute_states().shape == (3, 3, 22, 80) and vrb.compute_states().any()
+        vrb.step(["h", "Q", "j"])
+        rewards, new_states, terminals = vrb.step(["h", "y", "j"])
+        assert terminals.tolist() == [False, True, False]
+        assert list(vrb.final_states) == [1] and not vrb.final_states[1].any()
+        assert np.all(new_states.any(axis=(1, 2, 3)))
+        assert len(vrb.get_legal_actions()) == 3
+    finally:
+        vrb.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Check that the terminal backends render rogue sessions the same way.
+
+    python compare_terminals.py record session.bin [rogue] [steps]
+        play [steps] random commands and save everything rogue writes
+    python compare_terminals.py replay session.bin
+        feed the recording to every backend and report the first differing screen
+"""
+
+import os
+import sys
+import time
+import select
+import struct
+import random
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from rogueinabox import spawn, terminals, screen_to_array
+
+
+def read_chunks(path):
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(4)
+            if not header:
+                return chunks
+            length, = struct.unpack("<I", header)
+            chunks.append(f.read(length))
+
+
+def read_output(pipe, timeout=0.1):
+    """return the chunks rogue writes until it stays quiet for 'timeout' seconds"""
+    chunks = []
+    while select.select([pipe], [], [], timeout)[0]:
+        try:
+            chunk = pipe.read(4096)
+        except OSError:
+            break
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return chunks
+
+
+def record(path, rogue, steps):
+    pid, pipe = spawn(rogue)
+    time.sleep(0.5)
+    chunks = read_output(pipe)
+    for _ in range(steps):
+        pipe.write(random.choice("hjkl>hjklHJKLyubn.s ").encode())
+        chunks += read_output(pipe)
+    os.kill(pid, 9)
+    pipe.close()
+    with open(path, "wb") as f:
+        for chunk in chunks:
+            f.write(struct.pack("<I", len(chunk)))
+            f.write(chunk)
+    print("recorded %d chunks" % len(chunks))
+
+
+def replay(path):
+    chunks = read_chunks(path)
+    backends = {name: terminal_class(80, 24) for name, terminal_class in terminals.items()}
+    for n, chunk in enumerate(chunks):
+        screens = {}
+        for name, terminal in backends.items():
+            terminal.feed(chunk)
+            screens[name] = terminal.read()
+        (first_name, first_screen), *others = screens.items()
+        for name, screen in others:
+            # cell by cell, the rendered lines could hide a different length or encoding
+            cells = np.argwhere(screen_to_array(screen) != screen_to_array(first_screen))
+            if len(cells):
+                print("chunk %d: %s and %s differ in %d cells" % (n, first_name, name, len(cells)))
+                for y, x in cells[:10]:
+                    print("row %2d column %2d: %s %r, %s %r" % (y, x, first_name, first_screen[y][x],
+                                                               name, screen[y][x]))
+                return False
+    print("%d chunks, all the backends agree" % len(chunks))
+    return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("record", "replay"):
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "record":
+        rogue = sys.argv[3] if len(sys.argv) > 3 else "rogue"
+        steps = int(sys.argv[4]) if len(sys.argv) > 4 else 1000
+        record(sys.argv[2], rogue, steps)
+    else:
+        sys.exit(0 if replay(sys.argv[2]) else 1)
@@ -0,0 +1,324 @@
+#Copyright (C) 2017 Andrea Asperti, Carlo De Pieri, Gianmaria Pedrini
+#
+#This file is part of Rogueinabox.
+#
+#Rogueinabox is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Rogueinabox is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import select
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+import states
+from rogueinabox import RogueBox
+from profiler import merge_profiles
+
+
+class VecRogueBox:
+    """Run several rogue games side by side and step all of them at once.
+    The output of every rogue process is collected in a single epoll loop, so
+    a step costs about one pty round trip no matter how many games are running.
+    The epoll object lives as long as the VecRogueBox, a game is registered again
+    whenever its rogue process is restarted."""
+
+    def __init__(self, configs, num_envs=None):
+        """start num_envs rogue games (configs["num_envs"] if not given)"""
+        self.configs = configs
+        self.num_envs = num_envs or self.configs["num_envs"]
+        self.refresh_timeout = self.configs["refresh_timeout"]
+        self.settle_timeout = self.configs["settle_timeout"]
+        self.boxes = [RogueBox(configs) for _ in range(self.num_envs)]
+        # last states of the games that ended during the last step, {env_index: state}
+        self.final_states = {}
+        self._epoll = select.epoll()
+        # the registered pipes, {fd: env_index} and {env_index: fd}
+        self._envs = {}
+        self._fds = {}
+        for i in range(self.num_envs):
+            self._register(i)
+
+    def _register(self, i):
+        """listen to the pipe of the i-th game"""
+        fd = self.boxes[i].pipe.fileno()
+        self._epoll.register(fd, select.EPOLLIN)
+        self._envs[fd] = i
+        self._fds[i] = fd
+
+    def _unregister(self, i):
+        """stop listening to the pipe of the i-th game, if it still does"""
+        fd = self._fds.pop(i, None)
+        if fd is not None:
+            del self._envs[fd]
+            self._epoll.unregister(fd)
+
+    def _reset_box(self, i):
+        """restart the i-th game, its rogue process gets a new pipe"""
+        # unregister before the pipe is closed, its fd may be reused by the new one
+        self._unregister(i)
+        self.boxes[i].reset()
+        self._register(i)
+
+    def get_actions(self):
+        """return the list of actions"""
+        return self.boxes[0].get_actions()
+
+    def get_state_shape(self):
+        """return the shape of the state of a game"""
+        return self.boxes[0].get_state_shape()
+
+    def compute_states(self):
+        """return the current states of all the games stacked in a single array"""
+        return np.stack([box.compute_state() for box in self.boxes])
+
+    def step(self, commands):
+        """send commands[i] to the i-th game and return the batched
+        (rewards, new_states, terminals) of the transitions.
+        Games that ended are restarted: their row in new_states is the first state of
+        the new game, the state they ended in is stored in self.final_states"""
+        old_screens = [box.screen[:] for box in self.boxes]
+        for box, command in zip(self.boxes, commands):
+            box.profiler.start_step()
+            box._write_command(command)
+            box.profiler.mark("write")
+        updates = self._wait_for_updates()
+        for box in self.boxes:
+            box.profiler.mark("wait")
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        terminals = np.zeros(self.num_envs, dtype=bool)
+        new_states = []
+        self.final_states = {}
+        for i, box in enumerate(self.boxes):
+            box._apply_update(updates[i])
+            reward, new_state, terminal = box._complete_command(old_screens[i])
+            box.profiler.end_step()
+            if terminal:
+                self.final_states[i] = new_state
+                self._reset_box(i)
+                new_state = box.compute_state()
+            rewards[i] = reward
+            terminals[i] = terminal
+            new_states.append(new_state)
+        return rewards, np.stack(new_states), terminals
+
+    def _wait_for_updates(self):
+        """wait for the output of every game, return a list with the settled output of each.
+        Same policy as RogueBox._wait_for_update(), applied to each game independently"""
+        updates = [[] for _ in self.boxes]
+        start = time.perf_counter()
+        hard_deadline = start + self.refresh_timeout
+        # the time by which each game is considered settled, the games whose rogue exited are not waited
+        deadlines = {i: hard_deadline for i in self._fds}
+        while deadlines:
+            timeout = max(0, min(deadlines.values()) - time.perf_counter())
+            events = self._epoll.poll(timeout)
+            now = time.perf_counter()
+            for fd, event in events:
+                i = self._envs.get(fd)
+                if i is None:
+                    # unregistered by an earlier event of this poll
+                    continue
+                update = self.boxes[i]._read_pipe()
+                if update:
+                    updates[i].append(update)
+                    if i in deadlines:
+                        deadlines[i] = min(now + self.settle_timeout, hard_deadline)
+                else:
+                    # rogue exited, stop listening to it until the game is restarted
+                    self._unregister(i)
+                    deadlines.pop(i, None)
+            for i in [i for i, deadline in deadlines.items() if deadline <= now]:
+                del deadlines[i]
+        return [b"".join(update) for update in updates]
+
+    def get_legal_actions(self):
+        """return the list of legal actions of each game"""
+        return [box.get_legal_actions() for box in self.boxes]
+
+    def get_step_profile(self, reset=False):
+        """return the step profile of all the games merged, see RogueBox.get_step_profile().
+        The time spent reading the output of all the games is counted in the wait stage"""
+        return merge_profiles(box.get_step_profile(reset) for box in self.boxes)
+
+    def reset(self):
+        """restart all the games"""
+        for i in range(self.num_envs):
+            self._reset_box(i)
+        self.final_states = {}
+
+    def close(self):
+        """kill all the rogue processes"""
+        for i in list(self._fds):
+            self._unregister(i)
+        self._epoll.close()
+        for box in self.boxes:
+            box.close()
+
+    def is_running(self):
+        """check that all the rogue processes are running"""
+        return all(box.is_running() for box in self.boxes)
+
+    def quit_the_game(self):
+        """Send the keystrokes needed to quit all the games."""
+        for box in self.boxes:
+            box.quit_the_game()
+
+
+def _worker(remote, parent_remote, configs, num_envs, shape, states_name, final_states_name, first, last):
+    """body of a SubprocVecRogueBox worker: run the games first...last-1 and
+    write their states in the shared memory blocks"""
+    parent_remote.close()
+    states_shm = shared_memory.SharedMemory(name=states_name)
+    final_states_shm = shared_memory.SharedMemory(name=final_states_name)
+    all_states = np.ndarray((num_envs,) + shape, dtype=np.uint8, buffer=states_shm.buf)
+    all_final_states = np.ndarray((num_envs,) + shape, dtype=np.uint8, buffer=final_states_shm.buf)
+    my_states = all_states[first:last]
+    my_final_states = all_final_states[first:last]
+    vrb = VecRogueBox(configs, last - first)
+    my_states[:] = vrb.compute_states()
+    remote.send(None)
+    try:
+        while True:
+            command, data = remote.recv()
+            if command == "step":
+                rewards, new_states, terminals = vrb.step(data)
+                my_states[:] = new_states
+                for i, final_state in vrb.final_states.items():
+                    my_final_states[i] = final_state
+                remote.send((rewards, terminals, list(vrb.final_states)))
+            elif command == "reset":
+                vrb.reset()
+                my_states[:] = vrb.compute_states()
+                remote.send(None)
+            elif command == "legal_actions":
+                remote.send(vrb.get_legal_actions())
+            elif command == "step_profile":
+                remote.send(vrb.get_step_profile(data))
+            elif command == "quit_the_game":
+                vrb.quit_the_game()
+                remote.send(None)
+            elif command == "close":
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        vrb.close()
+        del my_states, my_final_states, all_states, all_final_states
+        states_shm.close()
+        final_states_shm.close()
+        remote.close()
+
+
+class SubprocVecRogueBox:
+    """Same interface of VecRogueBox, with the games spread over configs["num_workers"] processes.
+    Each worker owns a VecRogueBox and writes the states it computes straight into a shared
+    memory block, only the commands and the rewards/terminals go through the pipes.
+    The states array returned by step() is a view of the shared memory:
+    it is overwritten by the next step, copy it if you need to keep it."""
+
+    def __init__(self, configs, num_envs=None, num_workers=None):
+        self.configs = configs
+        self.num_envs = num_envs or self.configs["num_envs"]
+        self.num_workers = min(num_workers or self.configs["num_workers"], self.num_envs)
+        # the states are computed by the workers
+        shape = self._state_shape = getattr(states, self.configs["state_generator"]).state_shape()
+        size = int(np.prod((self.num_envs,) + shape))
+        self._states_shm = shared_memory.SharedMemory(create=True, size=size)
+        self._final_states_shm = shared_memory.SharedMemory(create=True, size=size)
+        self.states = np.ndarray((self.num_envs,) + shape, dtype=np.uint8, buffer=self._states_shm.buf)
+        self._final_states = np.ndarray((self.num_envs,) + shape, dtype=np.uint8,
+                                        buffer=self._final_states_shm.buf)
+        self.final_states = {}
+        # split the games as evenly as possible between the workers
+        bounds = [int(bound) for bound in np.linspace(0, self.num_envs, self.num_workers + 1)]
+        self._slices = list(zip(bounds[:-1], bounds[1:]))
+        self.remotes = []
+        self.processes = []
+        for first, last in self._slices:
+            remote, worker_remote = multiprocessing.Pipe()
+            args = (worker_remote, remote, configs, self.num_envs, shape,
+                    self._states_shm.name, self._final_states_shm.name, first, last)
+            process = multiprocessing.Process(target=_worker, args=args, daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        # wait for the workers to write the initial states
+        for remote in self.remotes:
+            remote.recv()
+
+    def get_actions(self):
+        """return the list of actions"""
+        return RogueBox.get_actions(self)
+
+    def get_state_shape(self):
+        """return the shape of the state of a game"""
+        return self._state_shape
+
+    def compute_states(self):
+        """return the current states of all the games (a view of the shared memory)"""
+        return self.states
+
+    def step(self, commands):
+        """send commands[i] to the i-th game and return the batched
+        (rewards, new_states, terminals) of the transitions, see VecRogueBox.step()"""
+        for remote, (first, last) in zip(self.remotes, self._slices):
+            remote.send(("step", list(commands[first:last])))
+        rewards = np.zeros(self.num_envs, dtype=np.float32)
+        terminals = np.zeros(self.num_envs, dtype=bool)
+        self.final_states = {}
+        for remote, (first, last) in zip(self.remotes, self._slices):
+            rewards[first:last], terminals[first:last], ended = remote.recv()
+            for i in ended:
+                self.final_states[first + i] = self._final_states[first + i]
+        return rewards, self.states, terminals
+
+    def _call(self, command, data=None):
+        for remote in self.remotes:
+            remote.send((command, data))
+        return [remote.recv() for remote in self.remotes]
+
+    def get_legal_actions(self):
+        """return the list of legal actions of each game"""
+        return [legal_actions for worker_legal_actions in self._call("legal_actions")
+                for legal_actions in worker_legal_actions]
+
+    def get_step_profile(self, reset=False):
+        """return the step profile of all the games merged, see RogueBox.get_step_profile()"""
+        return merge_profiles(self._call("step_profile", reset))
+
+    def reset(self):
+        """restart all the games"""
+        self._call("reset")
+        self.final_states = {}
+
+    def quit_the_game(self):
+        """Send the keystrokes needed to quit all the games."""
+        self._call("quit_the_game")
+
+    def close(self):
+        """stop the workers and release the shared memory"""
+        for remote in self.remotes:
+            try:
+                remote.send(("close", None))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+        del self.states, self._final_states
+        self.final_states = {}
+        self._states_shm.close()
+        self._states_shm.unlink()
+        self._final_states_shm.close()
+        self._final_states_shm.unlink()